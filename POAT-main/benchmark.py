@@ -0,0 +1,540 @@
+"""
+Timing comparisons for the featurization and model code paths.
+
+Usage: python benchmark.py [name ...]
+"""
+import collections
+import functools
+import glob
+import sys
+import time
+
+import numpy as np
+import torch
+from scipy.spatial.distance import squareform, pdist
+
+import AMD
+from pdd_helpers import _collapse_into_groups, custom_PDD, neighbour_query
+
+
+def _time(fn, *args, repeats=3, **kwargs):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _collapse_into_groups_dense(overlapping):
+    # Previous implementation of pdd_helpers._collapse_into_groups, kept as the baseline
+    overlapping = squareform(overlapping)
+    group_nums = {}  # row_ind: group number
+    group = 0
+    for i, row in enumerate(overlapping):
+        if i not in group_nums:
+            group_nums[i] = group
+            group += 1
+
+            for j in np.argwhere(row).T[0]:
+                if j not in group_nums:
+                    group_nums[j] = group_nums[i]
+
+    groups = collections.defaultdict(list)
+    for row_ind, group_num in sorted(group_nums.items()):
+        groups[group_num].append(row_ind)
+    groups = list(groups.values())
+
+    return groups
+
+
+def _symmetric_rows(n, k=15, multiplicity=4, seed=0):
+    # Motif of n rows made of n / multiplicity distinct environments, as in a symmetric crystal
+    rng = np.random.default_rng(seed)
+    distinct = np.sort(rng.random((max(n // multiplicity, 1), k)), axis=1)
+    rows = distinct[np.arange(n) % len(distinct)]
+    return rows + rng.random(rows.shape) * 1e-6
+
+
+def collapse_into_groups(sizes=(16, 64, 128, 256, 500, 1000, 2000), collapse_tol=1e-4):
+    print(f"{'rows':>6} {'dense (ms)':>12} {'sparse (ms)':>12} {'speedup':>8}")
+    for n in sizes:
+        overlapping = pdist(_symmetric_rows(n), metric="chebyshev") <= collapse_tol
+        assert [list(map(int, g)) for g in _collapse_into_groups_dense(overlapping)] == \
+            _collapse_into_groups(overlapping)
+        dense = _time(_collapse_into_groups_dense, overlapping)
+        sparse = _time(_collapse_into_groups, overlapping)
+        print(f"{n:>6} {dense * 1e3:>12.2f} {sparse * 1e3:>12.2f} {dense / sparse:>7.1f}x")
+
+
+def _supercell(ps, n):
+    shifts = np.array([[a, b, c] for a in range(n) for b in range(n) for c in range(n)])
+    motif = (ps.motif[None, :, :] + (shifts @ ps.cell)[:, None, :]).reshape((-1, 3))
+    return AMD.PeriodicSet(motif, ps.cell * n, types=np.tile(ps.types, len(shifts)))
+
+
+def collapse_methods(cif="./data/ABACUF01_FSR.cif", supercells=(1, 2, 3, 4, 5), k=15, collapse_tol=1e-4):
+    ps = AMD.CifReader(cif).read()
+    print(f"{'rows':>6} {'pdist (ms)':>12} {'kdtree (ms)':>12} {'speedup':>8}")
+    for n in supercells:
+        s = _supercell(ps, n)
+        a = custom_PDD(s, k, collapse_tol=collapse_tol, collapse_method="pdist")
+        b = custom_PDD(s, k, collapse_tol=collapse_tol, collapse_method="kdtree")
+        assert np.array_equal(a[0], b[0])
+        dense = _time(custom_PDD, s, k, collapse_tol=collapse_tol, collapse_method="pdist")
+        sparse = _time(custom_PDD, s, k, collapse_tol=collapse_tol, collapse_method="kdtree")
+        print(f"{len(s.motif):>6} {dense * 1e3:>12.2f} {sparse * 1e3:>12.2f} {dense / sparse:>7.1f}x")
+
+
+def _matbench_structures(task_name, n):
+    from matbench.bench import MatbenchBenchmark
+    mb = MatbenchBenchmark(autoload=False, subset=[task_name])
+    task = getattr(mb, task_name)
+    task.load()
+    return list(task.df["structure"].iloc[:n])
+
+
+def _symmetric_structures():
+    # High-symmetry crystals built orbit by orbit, where most sites are symmetry copies
+    from pymatgen.core import Lattice, Structure
+    spinel = Structure.from_spacegroup("Fd-3m", Lattice.cubic(8.08), ["Mg", "Al", "O"],
+                                       [[0.125, 0.125, 0.125], [0.5, 0.5, 0.5], [0.2624, 0.2624, 0.2624]])
+    spinel_supercell = spinel.copy()
+    spinel_supercell.make_supercell([2, 2, 2])
+    return [Structure.from_spacegroup("Fm-3m", Lattice.cubic(5.64), ["Na", "Cl"], [[0, 0, 0], [0.5, 0.5, 0.5]]),
+            spinel,
+            Structure.from_spacegroup("Ia-3d", Lattice.cubic(12.0), ["Y", "Al", "Al", "O"],
+                                      [[0.125, 0, 0.25], [0, 0, 0], [0.375, 0, 0.25], [-0.0314, 0.0512, 0.15]]),
+            spinel_supercell]
+
+
+def asymmetric_unit(tasks=("matbench_jdft2d", "matbench_phonons", "matbench_dielectric", "matbench_perovskites"),
+                    n=500, k=15, collapse_tol=1e-4):
+    # Falls back to the CIFs in ./data read through pymatgen when the matbench datasets are unavailable
+    from pymatgen.core import Structure
+    try:
+        sources = {name: _matbench_structures(name, n) for name in tasks}
+    except Exception as e:
+        print(f"Matbench unavailable ({e}), using ./data")
+        structures = []
+        for cif in sorted(glob.glob("./data/*.cif"))[:n]:
+            try:
+                structures.append(Structure.from_file(cif))
+            except Exception:
+                continue
+        sources = {"./data": structures}
+    sources["symmetric"] = _symmetric_structures()
+
+    print(f"{'dataset':>22} {'n':>5} {'sites/row':>11} {'full (s)':>9} {'asym (s)':>9} {'speedup':>8} "
+          f"{'rows differ':>11} {'max diff':>9}")
+    for name, structures in sources.items():
+        periodic_sets = [AMD.periodicset_from_pymatgen_structure(s) for s in structures]
+        full_time, asym_time, differ, max_diff = 0, 0, 0, 0
+        for ps in periodic_sets:
+            # The first calls are not timed, they include one-off warm-up costs
+            full = custom_PDD(ps, k, collapse_tol=collapse_tol, collapse_method="kdtree")[0]
+            asym = custom_PDD(ps, k, collapse_tol=collapse_tol, collapse_method="kdtree", use_asymmetric_unit=True)[0]
+            full_time += _time(custom_PDD, ps, k, collapse_tol=collapse_tol, collapse_method="kdtree")
+            asym_time += _time(custom_PDD, ps, k, collapse_tol=collapse_tol, collapse_method="kdtree",
+                               use_asymmetric_unit=True)
+            if full.shape != asym.shape:
+                differ += 1
+            else:
+                max_diff = max(max_diff, np.abs(full - asym).max())
+        ratio = np.mean([len(ps.motif) / len(neighbour_query(ps, k, True, collapse_tol)[0]) for ps in periodic_sets])
+        print(f"{name:>22} {len(periodic_sets):>5} {ratio:>11.2f} {full_time:>9.2f} {asym_time:>9.2f} "
+              f"{full_time / asym_time:>7.1f}x {differ:>11} {max_diff:>9.1e}")
+
+
+def _data_row_counts(k=15, collapse_tol=1e-4):
+    # Row counts of the collapsed PDDs of the CIFs in ./data, a realistic mix of motif sizes
+    counts = []
+    for cif in sorted(glob.glob("./data/*.cif")):
+        try:
+            counts.append(custom_PDD(AMD.CifReader(cif).read(), k, collapse_tol=collapse_tol)[0].shape[0])
+        except Exception:
+            continue
+    return np.array(counts)
+
+
+class _RandomPDDs(object):
+    # Dataset of random PDD-shaped items with the given row counts
+    def __init__(self, row_counts, k=15, seed=0):
+        rng = np.random.default_rng(seed)
+        self.items = []
+        for n in row_counts:
+            pdd = rng.random((n, k + 1)).astype(np.float32)
+            pdd[:, 0] /= pdd[:, 0].sum()
+            self.items.append((torch.from_numpy(pdd), torch.from_numpy(rng.integers(1, 90, (n, 1))).float(),
+                               torch.rand(6), torch.rand(1), len(self.items)))
+        self.pdds = [item[0] for item in self.items]
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, idx):
+        return self.items[idx]
+
+
+def bucketing(bucket_sizes=(1, 10, 50), batch_size=32, k=15, epochs=2, max_tokens=(1024, 2048)):
+    from torch.utils.data import DataLoader
+    from data import BucketBatchSampler, collate_pool, padding_fraction
+    from model import PeriodicSetTransformer
+
+    row_counts = _data_row_counts(k)
+    dataset = _RandomPDDs(row_counts, k)
+    print(f"{len(dataset)} structures, rows min {row_counts.min()} median {int(np.median(row_counts))} "
+          f"max {row_counts.max()}")
+    print(f"{'bucket size':>11} {'max tokens':>10} {'batches':>8} {'padding':>8} {'structures/s':>13}")
+    configs = [(bucket_size, None) for bucket_size in bucket_sizes] + [(50, tokens) for tokens in max_tokens]
+    for bucket_size, tokens in configs:
+        torch.manual_seed(0)
+        model = PeriodicSetTransformer(k + 1, 128, 2, n_encoders=4, use_cuda=False)
+        optimizer = torch.optim.Adam(model.parameters())
+        sampler = BucketBatchSampler(range(len(dataset)), row_counts, batch_size, bucket_size, max_tokens=tokens)
+        padding = np.mean([padding_fraction(sampler.batches(), row_counts) for _ in range(10)])
+        n_batches = len(sampler)
+        loader = DataLoader(dataset, batch_sampler=sampler, collate_fn=collate_pool)
+        start = time.perf_counter()
+        for _ in range(epochs):
+            for inputs, target, _ in loader:
+                loss = torch.nn.functional.l1_loss(model(inputs), target)
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+        rate = epochs * len(dataset) / (time.perf_counter() - start)
+        print(f"{bucket_size:>11} {str(tokens):>10} {n_batches:>8} {padding:>8.3f} {rate:>13.1f}")
+
+
+def masked_attention(batch_size=32, k=15, repeats=3):
+    from torch.utils.data import DataLoader
+    from data import BucketBatchSampler, collate_pool
+    from model import PeriodicSetTransformer
+
+    row_counts = _data_row_counts(k)
+    dataset = _RandomPDDs(row_counts, k)
+    # Padding must not change the prediction of a structure with the mask, it does without
+    small, large = int(np.argmin(row_counts)), int(np.argmax(row_counts))
+    for mask_padding in (False, True):
+        torch.manual_seed(0)
+        model = PeriodicSetTransformer(k + 1, 128, 2, use_cuda=False, mask_padding=mask_padding).eval()
+        with torch.no_grad():
+            alone = model(collate_pool([dataset[small]])[0])[0]
+            padded = model(collate_pool([dataset[small], dataset[large]])[0])[0]
+        print(f"mask_padding={mask_padding}: max change from padding {(alone - padded).abs().max().item():.1e}")
+
+    print(f"{'bucket size':>11} {'unmasked (s)':>12} {'masked (s)':>11} {'speedup':>8}")
+    for bucket_size in (1, 50):
+        times = {}
+        for mask_padding in (False, True):
+            torch.manual_seed(0)
+            model = PeriodicSetTransformer(k + 1, 128, 2, n_encoders=4, use_cuda=False, mask_padding=mask_padding)
+            optimizer = torch.optim.Adam(model.parameters())
+            loader = DataLoader(dataset, collate_fn=collate_pool,
+                                batch_sampler=BucketBatchSampler(range(len(dataset)), row_counts, batch_size, bucket_size))
+
+            def epoch():
+                for inputs, target, _ in loader:
+                    loss = torch.nn.functional.l1_loss(model(inputs), target)
+                    optimizer.zero_grad()
+                    loss.backward()
+                    optimizer.step()
+            times[mask_padding] = _time(epoch, repeats=repeats)
+        print(f"{bucket_size:>11} {times[False]:>12.2f} {times[True]:>11.2f} {times[False] / times[True]:>7.2f}x")
+
+
+def _peak_rss_delta(fn, *args):
+    # Peak resident memory reached while running fn, relative to before (Linux only)
+    def rss(field):
+        with open("/proc/self/status") as f:
+            return next(int(line.split()[1]) for line in f if line.startswith(field)) * 1024
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")  # reset the peak
+    before = rss("VmRSS:")
+    fn(*args)
+    return rss("VmHWM:") - before
+
+
+def attention_backends(sizes=(64, 256, 1024, 2048), batch_size=8, embed_dim=128, chunk_size=128):
+    from model import SA_Layer
+
+    print(f"{'rows':>6} {'backend':>8} {'forward (ms)':>13} {'peak memory (MB)':>17} {'max diff':>9}")
+    for n in sizes:
+        torch.manual_seed(0)
+        x = torch.randn(batch_size, embed_dim, n)
+        layers = {attention: SA_Layer(embed_dim, attention=attention, chunk_size=chunk_size).eval()
+                  for attention in ("bmm", "chunked", "sdpa")}
+        for layer in layers.values():
+            layer.load_state_dict(layers["bmm"].state_dict())
+        with torch.no_grad():
+            reference = layers["bmm"](x)
+            for attention, layer in layers.items():
+                diff = (layer(x) - reference).abs().max().item()
+                latency = _time(layer, x)
+                memory = _peak_rss_delta(layer, x)
+                print(f"{n:>6} {attention:>8} {latency * 1e3:>13.1f} {memory / 1024 ** 2:>17.1f} {diff:>9.1e}")
+
+
+def vector_attention(sizes=(64, 128, 256), chunk_sizes=(None, 64, 16), batch_size=4, embed_dim=64):
+    from model import VectorAttention
+
+    print(f"{'rows':>6} {'chunk':>6} {'forward (ms)':>13} {'peak memory (MB)':>17} {'max diff':>9}")
+    for n in sizes:
+        torch.manual_seed(0)
+        feat = torch.randn(batch_size, n, embed_dim)
+        distribution = torch.rand(batch_size, n, 1)
+        distribution[:, n // 2:] = 0  # padding
+        layer = VectorAttention(embed_dim).eval()
+        with torch.no_grad():
+            reference = layer(feat, distribution)
+            for chunk_size in chunk_sizes:
+                layer.chunk_size = chunk_size
+                diff = (layer(feat, distribution) - reference).abs().max().item()
+                latency = _time(layer, feat, distribution)
+                memory = _peak_rss_delta(layer, feat, distribution)
+                print(f"{n:>6} {str(chunk_size):>6} {latency * 1e3:>13.1f} {memory / 1024 ** 2:>17.1f} {diff:>9.1e}")
+
+
+def packed_batches(batch_size=32, k=15, repeats=3):
+    from torch.utils.data import DataLoader
+    from data import collate_packed, collate_pool, padding_fraction
+    from model import PeriodicSetTransformer
+
+    row_counts = _data_row_counts(k)
+    dataset = _RandomPDDs(row_counts, k)
+    batches = [list(range(i, min(i + batch_size, len(dataset)))) for i in range(0, len(dataset), batch_size)]
+    print(f"padding fraction of the padded batches: {padding_fraction(batches, row_counts):.3f}")
+    configs = [("padded", collate_pool, False), ("padded + mask", collate_pool, True),
+               ("packed", collate_packed, True)]
+    print(f"{'batches':>14} {'train epoch (s)':>16} {'max diff':>9}")
+    reference = None
+    for name, collate_fn, mask_padding in configs:
+        torch.manual_seed(0)
+        model = PeriodicSetTransformer(k + 1, 128, 2, n_encoders=4, use_cuda=False, mask_padding=mask_padding)
+        # Predictions of the untrained model, packed must match padded with the mask
+        model.eval()
+        with torch.no_grad():
+            predictions = torch.cat([model(collate_fn([dataset[i] for i in batch])[0]) for batch in batches])
+        if mask_padding and reference is None:
+            reference = predictions
+        diff = (predictions - reference).abs().max().item() if mask_padding else float("nan")
+
+        model.train()
+        optimizer = torch.optim.Adam(model.parameters())
+        loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, collate_fn=collate_fn)
+
+        def epoch():
+            for inputs, target, _ in loader:
+                loss = torch.nn.functional.l1_loss(model(inputs), target)
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+        seconds = _time(epoch, repeats=repeats)
+        print(f"{name:>14} {seconds:>16.2f} {diff:>9.1e}")
+
+
+def _data_dataset(k=15):
+    # PDDDataPymatgen over the CIFs in ./data, read through pymatgen
+    import pandas as pd
+    from pymatgen.core import Structure
+    from data import PDDDataPymatgen
+    structures, ids = [], []
+    for cif in sorted(glob.glob("./data/*.cif")):
+        try:
+            structures.append(Structure.from_file(cif))
+            ids.append(cif)
+        except Exception:
+            continue
+    return PDDDataPymatgen(pd.Series(structures, index=ids), pd.Series(np.zeros(len(ids)), index=ids), k=k)
+
+
+def resident_loader(batch_size=32, k=15, epochs=5):
+    import tempfile
+    from torch.utils.data import DataLoader, SubsetRandomSampler
+    from data import PackedPDDData, ResidentLoader, ResidentTensors, collate_packed, collate_pool, pack_dataset
+
+    dataset = _data_dataset(k)
+    store = tempfile.mkdtemp()
+    pack_dataset(dataset, store)
+    # PDDDataPymatgen is timed with a warm lru_cache, PackedPDDData builds every item from the memmaps
+    datasets = {"PDDDataPymatgen": dataset, "PackedPDDData": PackedPDDData(store)}
+    print(f"{'dataset':>16} {'loader':>22} {'epoch (ms)':>11} {'batches/s':>10}")
+    for dataset_name, dataset in datasets.items():
+        sampler = SubsetRandomSampler(range(len(dataset)))
+        start = time.perf_counter()
+        tensors = ResidentTensors(dataset)
+        print(f"{dataset_name:>16} {'(packing)':>22} {(time.perf_counter() - start) * 1e3:>11.1f}")
+        loaders = {
+            "DataLoader padded": DataLoader(dataset, batch_size=batch_size, sampler=sampler, collate_fn=collate_pool),
+            "DataLoader packed": DataLoader(dataset, batch_size=batch_size, sampler=sampler,
+                                            collate_fn=collate_packed),
+            "ResidentLoader padded": ResidentLoader(tensors, sampler, batch_size),
+            "ResidentLoader packed": ResidentLoader(tensors, sampler, batch_size, packed=True),
+        }
+        for name, loader in loaders.items():
+            for _ in loader:
+                pass
+            seconds = _time(lambda: [batch for batch in loader], repeats=epochs)
+            print(f"{dataset_name:>16} {name:>22} {seconds * 1e3:>11.1f} {len(loader) / seconds:>10.1f}")
+
+
+class _LruCachedItems(torch.utils.data.Dataset):
+    # Previous item path of the featurized datasets, kept as the baseline
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    @functools.lru_cache(maxsize=None)
+    def __getitem__(self, idx):
+        pdd, atom_features, cell_features, target, cif_id = self.dataset[idx]
+        return pdd.clone(), atom_features.clone(), cell_features.clone(), target.clone(), cif_id
+
+
+def _private_memory(pid):
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        return sum(int(line.split()[1]) for line in f if line.startswith(("Private_Clean", "Private_Dirty"))) * 1024
+
+
+def shared_storage(worker_counts=(1, 2, 4), repeats=30, batch_size=64, k=15):
+    import pandas as pd
+    from torch.utils.data import DataLoader
+    from data import PDDDataSubset, _share_memory, collate_pool
+
+    dataset = _data_dataset(k)
+    targets = dataset.id_prop_data
+    # Every structure repeated, the rows stay in the parent dataset's storage
+    large = PDDDataSubset(dataset, pd.Series(np.tile(targets.values, repeats), index=np.tile(targets.index, repeats)))
+    _share_memory(large)  # as get_train_val_test_loader does when num_workers > 0
+    print(f"{len(large)} items, {dataset.storage.pdds.numel() * 4 / 1024 ** 2:.1f} MB of PDD rows in shared memory")
+    print(f"{'items':>14} {'workers':>8} {'private MB per worker':>22}")
+    for name, items in (("lru_cache", _LruCachedItems(large)), ("shared", large)):
+        for workers in worker_counts:
+            loader = DataLoader(items, batch_size=batch_size, shuffle=True, num_workers=workers,
+                                persistent_workers=True, collate_fn=collate_pool)
+            for _ in range(2):
+                for _ in loader:
+                    pass
+            pids = [w.pid for w in loader._iterator._workers]
+            private = np.mean([_private_memory(pid) for pid in pids])
+            print(f"{name:>14} {workers:>8} {private / 1024 ** 2:>22.1f}")
+            del loader
+
+
+def prefetch(batch_size=32, k=15, epochs=3):
+    import contextlib
+    import io
+    from torch.utils.data import DataLoader
+    from data import collate_pool
+    from model import PeriodicSetTransformer
+    from train import Normalizer, train
+
+    # Small model with num_workers=0, the case where batch preparation is a large part of a step
+    dataset = _data_dataset(k)
+    normalizer = Normalizer(torch.randn(100))
+    print(f"{'prefetch':>8} {'epoch (s)':>10} {'hidden (s)':>11} {'preparation (s)':>16}")
+    weights = {}
+    for use_prefetch in (False, True):
+        torch.manual_seed(0)
+        model = PeriodicSetTransformer(k + 1, 32, 2, n_encoders=1, use_cuda=False)
+        optimizer = torch.optim.Adam(model.parameters())
+        loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=0, collate_fn=collate_pool)
+        seconds = []
+        for epoch in range(epochs):
+            out = io.StringIO()
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(out):
+                train(loader, model, torch.nn.L1Loss(), optimizer, epoch, normalizer, cuda=False, prefetch=use_prefetch)
+            seconds.append(time.perf_counter() - start)
+        weights[use_prefetch] = torch.cat([p.detach().flatten() for p in model.parameters()])
+        hidden, prepared = "-", "-"
+        if use_prefetch:
+            line = [l for l in out.getvalue().splitlines() if "prefetch hid" in l][-1].split()
+            hidden, prepared = line[4].rstrip("s"), line[6].rstrip("s")
+        print(f"{str(use_prefetch):>8} {min(seconds):>10.2f} {hidden:>11} {prepared:>16}")
+    print(f"max weight difference after training: {(weights[False] - weights[True]).abs().max().item():.1e}")
+
+
+def normalizer(n=20000, k=15):
+    from data import SharedStorage, collate_pool, dataset_targets
+    from train import Normalizer
+
+    # Long-tailed row counts, so padding every item to the largest one dominates the collated batch
+    dataset = _RandomPDDs(np.minimum(np.random.default_rng(0).pareto(1.5, n) * 8 + 1, 500).astype(int), k=k)
+    storage = SharedStorage(dataset.pdds, [item[1] for item in dataset.items], [item[2].numpy() for item in dataset.items],
+                            [float(item[3]) for item in dataset.items])
+    results = {}
+
+    def collated():
+        results["collate_pool"] = Normalizer(collate_pool([dataset[i] for i in range(len(dataset))])[1])
+
+    def streamed():
+        results["from_targets (items)"] = Normalizer.from_targets(dataset_targets(dataset))
+
+    def stored():
+        results["from_targets (stored)"] = Normalizer.from_targets(storage.targets)
+
+    print(f"{'method':>22} {'time (s)':>9} {'peak memory (MB)':>17} {'mean':>9} {'std':>9}")
+    for name, fn in (("collate_pool", collated), ("from_targets (items)", streamed), ("from_targets (stored)", stored)):
+        seconds = _time(fn, repeats=1)
+        peak = _peak_rss_delta(fn)
+        print(f"{name:>22} {seconds:>9.3f} {peak / 1024 ** 2:>17.1f} "
+              f"{results[name].mean.item():>9.5f} {results[name].std.item():>9.5f}")
+
+
+def fused_embedding(batch_size=64, k=15, repeats=10):
+    from data import collate_pool
+    from model import PeriodicSetTransformer
+
+    dataset = _RandomPDDs(_data_row_counts(k), k)
+    batches = [collate_pool([dataset[i] for i in range(start, min(start + batch_size, len(dataset)))])[0]
+               for start in range(0, len(dataset), batch_size)]
+    torch.manual_seed(0)
+    model = PeriodicSetTransformer(k + 1, 128, 2, n_encoders=1, use_cuda=False)
+    optimizer = torch.optim.Adam(model.parameters())
+    # A few steps so the table has to be rebuilt from updated weights
+    for inputs in batches[:3]:
+        optimizer.zero_grad()
+        model(inputs).mean().backward()
+        optimizer.step()
+    model.eval()
+
+    def embed(fused):
+        model.fuse_embedding = fused
+        with torch.no_grad():
+            return [model.comp_table()[comp_fea.long()].squeeze(-2) if fused else
+                    model.comp_embedding_layer(model.af(comp_fea)) for _, comp_fea, _ in batches]
+
+    def predict(fused):
+        model.fuse_embedding = fused
+        with torch.no_grad():
+            return torch.cat([model(inputs) for inputs in batches])
+
+    print(f"{'fused':>6} {'embedding (ms)':>15} {'forward (ms)':>13}")
+    for fused in (False, True):
+        print(f"{str(fused):>6} {_time(embed, fused, repeats=repeats) * 1e3:>15.2f} "
+              f"{_time(predict, fused, repeats=repeats) * 1e3:>13.2f}")
+    print(f"max prediction difference: {(predict(False) - predict(True)).abs().max().item():.1e}")
+
+
+BENCHMARKS = {
+    "collapse_into_groups": collapse_into_groups,
+    "collapse_methods": collapse_methods,
+    "asymmetric_unit": asymmetric_unit,
+    "bucketing": bucketing,
+    "masked_attention": masked_attention,
+    "attention_backends": attention_backends,
+    "vector_attention": vector_attention,
+    "packed_batches": packed_batches,
+    "resident_loader": resident_loader,
+    "shared_storage": shared_storage,
+    "prefetch": prefetch,
+    "normalizer": normalizer,
+    "fused_embedding": fused_embedding,
+}
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or BENCHMARKS:
+        print(f"== {name}")
+        BENCHMARKS[name]()
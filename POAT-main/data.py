@@ -1,15 +1,18 @@
 import csv
+import hashlib
+import inspect
 import pickle
 import sys
+import warnings
 
 import AMD
 # import lmdb
 import pandas as pd
 import os
 import torch
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, IterableDataset, DataLoader, get_worker_info
 from torch.utils.data.dataloader import default_collate
-from torch.utils.data.sampler import SubsetRandomSampler, SequentialSampler
+from torch.utils.data.sampler import Sampler, SubsetRandomSampler, SequentialSampler
 from torch.nn.utils.rnn import pad_sequence
 import random
 import functools
@@ -18,18 +21,139 @@ import pickle
 from tqdm import tqdm
 
 from jarvis.db.figshare import data as jdata
-from jarvis.core.atoms import Atoms
 from pdd_helpers import custom_PDD, phi, coulomb_matrix
+from featurize import FEATURE_VERSION, featurize, _featurize_one
+from feature_store import FeatureStore, read_feature_store_meta, write_feature_store
 
 random.seed(0)
 
 
-def get_train_val_test_loader(dataset, collate_fn=default_collate,
-                              batch_size=64, train_ratio=None,
-                              val_ratio=0.1, test_ratio=0.1, return_test=False,
-                              num_workers=1, pin_memory=False, **kwargs):
-    total_size = len(dataset)
-    if kwargs['train_size'] is None:
+def dataset_row_counts(dataset):
+    """Number of PDD rows of every item, read from the features instead of building the items"""
+    if isinstance(dataset, torch.utils.data.Subset):
+        return dataset_row_counts(dataset.dataset)[np.asarray(dataset.indices, dtype=np.int64)]
+    if isinstance(dataset, PDDDataSubset):
+        return dataset_row_counts(dataset.dataset)[dataset.indices]
+    if isinstance(dataset, PackedPDDData):
+        return dataset.store.row_counts
+    if hasattr(dataset, "storage"):
+        return np.diff(dataset.storage.offsets)
+    if hasattr(dataset, "pdds"):
+        return np.array([pdd.shape[0] for pdd in dataset.pdds], dtype=np.int64)
+    return np.array([dataset[i][0].shape[0] for i in range(len(dataset))], dtype=np.int64)
+
+
+def dataset_targets(dataset):
+    """
+    Targets of every item as an (N, 1) tensor, read from the stored targets instead of
+    building the items. Datasets without stored targets give a generator over the items.
+    """
+    if isinstance(dataset, torch.utils.data.Subset):
+        targets = dataset_targets(dataset.dataset)
+        if isinstance(targets, torch.Tensor):
+            return targets[torch.as_tensor(dataset.indices, dtype=torch.long)]
+    elif isinstance(dataset, PDDDataSubset):
+        return dataset.targets
+    elif isinstance(dataset, PackedPDDData):
+        return torch.from_numpy(np.asarray(dataset.store.targets))[:, None]
+    elif isinstance(dataset, PDDStreamData):
+        return torch.Tensor([[float(target)] for _, target in dataset.id_prop_data])
+    elif hasattr(dataset, "storage"):
+        return dataset.storage.targets
+    return (dataset[i][3] for i in range(len(dataset)))
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Batches structures with similar PDD row counts to reduce the padding added by
+    collate_pool. Every epoch the indices are shuffled, cut into chunks of
+    bucket_size batches, each chunk is sorted by row count and split into batches,
+    and the order of all batches is shuffled again. bucket_size=1 is plain random
+    batching, larger buckets give less padding and less randomness.
+
+    With max_tokens a batch is instead filled until its padded size (structures x
+    largest row count) would exceed max_tokens. batch_size then only sets the chunk
+    size and max_batch_size optionally caps the structures per batch. A structure
+    larger than the budget is a batch of its own. The number of batches then varies
+    between epochs.
+    """
+
+    def __init__(self, indices, row_counts, batch_size, bucket_size=50, shuffle=True, drop_last=False,
+                 max_tokens=None, max_batch_size=None):
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.row_counts = np.asarray(row_counts)[self.indices]
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self._next_batches = None
+        self._epoch_batches = None
+
+    def _split(self, bucket):
+        if self.max_tokens is None:
+            return [bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size)]
+        batches, start, longest = [], 0, 0
+        for end, n in enumerate(self.row_counts[bucket]):
+            longest = max(longest, n)
+            size = end - start + 1
+            full = self.max_batch_size is not None and size > self.max_batch_size
+            if size > 1 and (size * longest > self.max_tokens or full):
+                batches.append(bucket[start:end])
+                start, longest = end, n
+        if start < len(bucket):
+            batches.append(bucket[start:])
+        return batches
+
+    def batches(self):
+        order = torch.randperm(len(self.indices)).numpy() if self.shuffle else np.arange(len(self.indices))
+        chunk = self.batch_size * self.bucket_size
+        batches = []
+        for start in range(0, len(order), chunk):
+            bucket = order[start:start + chunk]
+            bucket = bucket[np.argsort(self.row_counts[bucket], kind="stable")]
+            batches += self._split(bucket)
+        if self.drop_last and self.max_tokens is None:
+            batches = [b for b in batches if len(b) == self.batch_size]
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+        return [self.indices[b].tolist() for b in batches]
+
+    def __iter__(self):
+        batches = self._next_batches if self._next_batches is not None else self.batches()
+        self._next_batches = None
+        self._epoch_batches = batches
+        return iter(batches)
+
+    def __len__(self):
+        if self.max_tokens is not None:
+            # The batches of the epoch being iterated (DataLoader workers may have drawn them all
+            # already, so it stays current until the next __iter__), otherwise draw the next
+            # epoch's batches now so that len matches what __iter__ will yield
+            if self._epoch_batches is not None:
+                return len(self._epoch_batches)
+            if self._next_batches is None:
+                self._next_batches = self.batches()
+            return len(self._next_batches)
+        if self.drop_last:
+            return len(self.indices) // self.batch_size
+        chunk = self.batch_size * self.bucket_size
+        full, rest = divmod(len(self.indices), chunk)
+        return full * self.bucket_size + -(-rest // self.batch_size)
+
+
+def padding_fraction(batches, row_counts):
+    """Fraction of the padded PDD rows of the batches that are padding"""
+    row_counts = np.asarray(row_counts)
+    real = sum(int(row_counts[b].sum()) for b in batches)
+    padded = sum(len(b) * int(row_counts[b].max()) for b in batches)
+    return 1 - real / padded if padded else 0.0
+
+
+def _split_sizes(total_size, train_ratio, val_ratio, test_ratio, train_size=None, val_size=None, test_size=None):
+    # Train is taken from the start of the indices, validation and then test from the end
+    if train_size is None:
         if train_ratio is None:
             assert val_ratio + test_ratio < 1
             train_ratio = 1 - val_ratio - test_ratio
@@ -37,32 +161,83 @@ def get_train_val_test_loader(dataset, collate_fn=default_collate,
                   f'test_ratio = {train_ratio} as training data.')
         else:
             assert train_ratio + val_ratio + test_ratio <= 1
-    indices = list(range(total_size))
-    if kwargs['train_size']:
-        train_size = kwargs['train_size']
-    else:
-        train_size = int(train_ratio * total_size)
-    if kwargs['test_size']:
-        test_size = kwargs['test_size']
-    else:
-        test_size = int(test_ratio * total_size)
-    if kwargs['val_size']:
-        valid_size = kwargs['val_size']
+    train_size = train_size or int(train_ratio * total_size)
+    test_size = test_size or int(test_ratio * total_size)
+    val_size = val_size or int(val_ratio * total_size)
+    return train_size, val_size, test_size
+
+
+def get_train_val_test_loader(dataset, collate_fn=default_collate,
+                              batch_size=64, train_ratio=None,
+                              val_ratio=0.1, test_ratio=0.1, return_test=False,
+                              num_workers=1, pin_memory=False, bucket_size=None, max_tokens=None, resident=False,
+                              **kwargs):
+    """
+    With bucket_size the train and validation sets are batched by a BucketBatchSampler
+    instead of a SubsetRandomSampler. max_tokens switches to batches of at most that many
+    padded PDD rows (structures x largest row count). The test set always keeps the
+    dataset order, in batches of batch_size.
+
+    resident=True packs the dataset into ResidentTensors once and returns ResidentLoaders
+    (collate_fn must then be collate_pool or collate_packed, num_workers is ignored).
+    """
+    indices = list(range(len(dataset)))
+    train_size, valid_size, test_size = _split_sizes(len(dataset), train_ratio, val_ratio, test_ratio,
+                                                     kwargs['train_size'], kwargs['val_size'], kwargs['test_size'])
+    if resident:
+        if collate_fn not in (collate_pool, collate_packed):
+            raise ValueError("resident loaders only build collate_pool or collate_packed batches")
+        tensors = ResidentTensors(dataset)
+        packed = collate_fn is collate_packed
+        loader = functools.partial(ResidentLoader, tensors, batch_size=batch_size, packed=packed,
+                                   pin_memory=pin_memory)
+        if bucket_size or max_tokens:
+            row_counts = np.diff(tensors.offsets.numpy())
+            train_loader = loader(batch_sampler=BucketBatchSampler(indices[:train_size], row_counts, batch_size,
+                                                                   bucket_size or 50, max_tokens=max_tokens))
+            val_loader = loader(batch_sampler=BucketBatchSampler(indices[-(valid_size + test_size):-test_size],
+                                                                 row_counts, batch_size, bucket_size or 50,
+                                                                 max_tokens=max_tokens))
+        else:
+            train_loader = loader(sampler=SubsetRandomSampler(indices[:train_size]))
+            val_loader = loader(sampler=SubsetRandomSampler(indices[-(valid_size + test_size):-test_size]))
+        if return_test:
+            return train_loader, val_loader, loader(sampler=indices[-test_size:])
+        return train_loader, val_loader
+    if num_workers > 0:
+        _share_memory(dataset)
+    if bucket_size or max_tokens:
+        bucket_size = bucket_size or 50
+        row_counts = dataset_row_counts(dataset)
+        train_sampler = BucketBatchSampler(indices[:train_size], row_counts, batch_size, bucket_size,
+                                           max_tokens=max_tokens)
+        val_sampler = BucketBatchSampler(indices[-(valid_size + test_size):-test_size], row_counts,
+                                         batch_size, bucket_size, max_tokens=max_tokens)
+        random_batches = BucketBatchSampler(indices[:train_size], row_counts, batch_size, 1).batches()
+        train_batches = train_sampler.batches()
+        print(f"Padding fraction of the training batches: {padding_fraction(random_batches, row_counts):.3f} "
+              f"random, {padding_fraction(train_batches, row_counts):.3f} bucketed "
+              f"({len(train_batches)} batches)")
+        train_loader = DataLoader(dataset, batch_sampler=train_sampler,
+                                  num_workers=num_workers,
+                                  collate_fn=collate_fn, pin_memory=pin_memory)
+        val_loader = DataLoader(dataset, batch_sampler=val_sampler,
+                                num_workers=num_workers,
+                                collate_fn=collate_fn, pin_memory=pin_memory)
     else:
-        valid_size = int(val_ratio * total_size)
-    train_sampler = SubsetRandomSampler(indices[:train_size])
-    val_sampler = SubsetRandomSampler(
-        indices[-(valid_size + test_size):-test_size])
+        train_sampler = SubsetRandomSampler(indices[:train_size])
+        val_sampler = SubsetRandomSampler(
+            indices[-(valid_size + test_size):-test_size])
+        train_loader = DataLoader(dataset, batch_size=batch_size,
+                                  sampler=train_sampler,
+                                  num_workers=num_workers,
+                                  collate_fn=collate_fn, pin_memory=pin_memory)
+        val_loader = DataLoader(dataset, batch_size=batch_size,
+                                sampler=val_sampler,
+                                num_workers=num_workers,
+                                collate_fn=collate_fn, pin_memory=pin_memory)
     if return_test:
         test_sampler = SequentialSampler(indices[-test_size:])
-    train_loader = DataLoader(dataset, batch_size=batch_size,
-                              sampler=train_sampler,
-                              num_workers=num_workers,
-                              collate_fn=collate_fn, pin_memory=pin_memory)
-    val_loader = DataLoader(dataset, batch_size=batch_size,
-                            sampler=val_sampler,
-                            num_workers=num_workers,
-                            collate_fn=collate_fn, pin_memory=pin_memory)
     if return_test:
         test_set = torch.utils.data.Subset(dataset, indices[-test_size:])
         test_loader = DataLoader(test_set, batch_size=batch_size,
@@ -75,6 +250,35 @@ def get_train_val_test_loader(dataset, collate_fn=default_collate,
         return train_loader, val_loader
 
 
+def get_train_val_test_streams(data_options, collate_fn=default_collate, batch_size=64, train_ratio=None,
+                               val_ratio=0.1, test_ratio=0.1, num_workers=0, pin_memory=False, train_size=None,
+                               val_size=None, test_size=None, pdd_scaler=None, scaler_sample=1000,
+                               feature_cache=None, **kwargs):
+    """
+    Streaming counterpart of get_train_val_test_loader over the CIF directory of data_options
+    (the positional options of PDDDataNormalized, as main.py passes them): the train, validation
+    and test sets are PDDStreamData over disjoint parts of the shuffled id_prop.csv, split as
+    get_train_val_test_loader splits a dataset. Only the train stream is shuffled. Without
+    pdd_scaler one is fitted on the first scaler_sample structures (all of them if None) before
+    the loaders are built. Returns the three loaders and the train stream.
+    """
+    stream = functools.partial(PDDStreamData, *data_options, feature_cache=feature_cache, **kwargs)
+    full = stream()
+    total_size = len(full)
+    if pdd_scaler is None:
+        pdd_scaler = full.fit_scaler(scaler_sample)
+    train_size, val_size, test_size = _split_sizes(total_size, train_ratio, val_ratio, test_ratio,
+                                                   train_size, val_size, test_size)
+    indices = list(range(total_size))
+    train_set = stream(indices=indices[:train_size], pdd_scaler=pdd_scaler)
+    val_set = stream(indices=indices[-(val_size + test_size):-test_size], pdd_scaler=pdd_scaler,
+                     shuffle_items=False)
+    test_set = stream(indices=indices[-test_size:], pdd_scaler=pdd_scaler, shuffle_items=False)
+    loader = functools.partial(DataLoader, batch_size=batch_size, num_workers=num_workers, collate_fn=collate_fn,
+                               pin_memory=pin_memory)
+    return loader(train_set), loader(val_set), loader(test_set), train_set
+
+
 def collate_pool(dataset_list):
     batch_fea = []
     composition_fea = []
@@ -96,6 +300,37 @@ def collate_pool(dataset_list):
         batch_cif_ids
 
 
+def collate_packed(dataset_list):
+    """
+    Padding-free alternative to collate_pool: the PDD rows and atom types of all structures are
+    concatenated, cu_seqlens holds the offset of each structure and batch_index the structure of
+    each row. PeriodicSetTransformer accepts either form.
+    """
+    batch_fea = []
+    composition_fea = []
+    cell_fea = []
+    batch_target = []
+    batch_cif_ids = []
+
+    for i, (structure_features, comp_features, cell_features, target, cif_id) in enumerate(dataset_list):
+        batch_fea.append(structure_features)
+        composition_fea.append(comp_features)
+        cell_fea.append(cell_features)
+        batch_target.append(target)
+        batch_cif_ids.append(cif_id)
+
+    seqlens = torch.tensor([len(fea) for fea in batch_fea])
+    cu_seqlens = torch.cat([seqlens.new_zeros(1), torch.cumsum(seqlens, dim=0)])
+    batch_index = torch.repeat_interleave(torch.arange(len(batch_fea)), seqlens)
+    return (torch.cat(batch_fea, dim=0),
+            torch.cat(composition_fea, dim=0),
+            torch.stack(cell_fea, dim=0),
+            cu_seqlens,
+            batch_index), \
+        torch.stack(batch_target, dim=0), \
+        batch_cif_ids
+
+
 def collate_pretrain_pool(dataset_list):
     batch_fea = []
     composition_fea = []
@@ -156,16 +391,17 @@ class LatticeEnergyData(Dataset):
         pdds = [pdds[i] for i in indices_to_keep]
         min_pdd = np.min(np.vstack([np.min(pdd, axis=0) for pdd in pdds]), axis=0)
         max_pdd = np.max(np.vstack([np.max(pdd, axis=0) for pdd in pdds]), axis=0)
-        self.pdds = [np.hstack([pdd[:, 0, None], (pdd[:, 1:] - min_pdd[1:]) / (max_pdd[1:] - min_pdd[1:])]) for pdd in
-                     pdds]
+        pdds = [np.hstack([pdd[:, 0, None], (pdd[:, 1:] - min_pdd[1:]) / (max_pdd[1:] - min_pdd[1:])]) for pdd in
+                pdds]
+        self.storage = SharedStorage(pdds, [pdd[:, :0] for pdd in pdds], np.zeros((len(pdds), 0)), self.energies)
 
     def __len__(self):
-        return len(self.pdds)
+        return len(self.storage)
 
-    @functools.lru_cache(maxsize=None)  # Cache loaded structures
     def __getitem__(self, idx):
-        return torch.Tensor(self.pdds[idx]), \
-            torch.Tensor([float(self.energies[idx])]), \
+        pdd, _, _, energy = self.storage[idx]
+        return pdd, \
+            energy, \
             self.ids[idx]
 
 
@@ -213,7 +449,8 @@ class PDDData(Dataset):
 
 class PDDDataNormalized(Dataset):
     def __init__(self, filepath, k=15, collapse_tol=1e-4, composition=True, constrained=True,
-                 seed=8888, shuffle=True, collapse=True):
+                 seed=8888, shuffle=True, collapse=True, workers=None, feature_cache=None,
+                 use_asymmetric_unit=False, pdd_scaler=None):
         self.filepath = filepath
         assert os.path.exists(filepath), 'root_dir does not exist!'
         id_prop_file = os.path.join(self.filepath, 'id_prop.csv')
@@ -224,104 +461,313 @@ class PDDDataNormalized(Dataset):
         random.seed(seed)
         if shuffle:
             random.shuffle(self.id_prop_data)
+        self.seed = seed
+        self.shuffle = shuffle
         k = int(k)
         self.k = k
         self.collapse_tol = float(collapse_tol)
         self.constrained = constrained
+        self.collapse = collapse
         self.composition = composition
         print("k: " + str(k))
         print("ct: " + str(self.collapse_tol))
-        pdds = []
-        atom_fea = []
         periodic_sets = [AMD.CifReader(os.path.join(filepath, cif[0] + ".cif")).read() for cif in tqdm(self.id_prop_data, desc="Reading CIF files..")]
         self.cell_fea = [AMD.cell_to_cellpar(ps.cell) for ps in periodic_sets]
-        for i in tqdm(range(len(periodic_sets)),
-                      desc="Creating PDDs…",
-                      ascii=False, ncols=75):
-            ps = periodic_sets[i]
-            pdd, groups, inds, _ = custom_PDD(ps, k=self.k, collapse=collapse, collapse_tol=self.collapse_tol,
-                                              constrained=self.constrained, lexsort=False)
-            indices_in_graph = [i[0] for i in groups]
-            atom_features = ps.types[indices_in_graph][:, None]
-            atom_fea.append(atom_features)
-            pdds.append(pdd)
+        pdds, atom_fea = featurize(periodic_sets, k=self.k, collapse_tol=self.collapse_tol,
+                                   constrained=self.constrained, collapse=collapse, workers=workers,
+                                   cache=feature_cache, use_asymmetric_unit=use_asymmetric_unit)
 
-        self.pdds = preprocess_pdds(pdds)
-        self.atom_fea = atom_fea
+        self.pdd_scaler = pdd_scaler if pdd_scaler is not None else PDDScaler.fit(pdds)
+        self.storage = SharedStorage(pdds, atom_fea, self.cell_fea, [target for _, target in self.id_prop_data],
+                                     transform=self.pdd_scaler.transform)
 
     def __len__(self):
         return len(self.id_prop_data)
 
-    @functools.lru_cache(maxsize=None)  # Cache loaded structures
     def __getitem__(self, idx):
-        cif_id, target = self.id_prop_data[idx]
-        return torch.Tensor(self.pdds[idx]), \
-            torch.Tensor(self.atom_fea[idx]), \
-            torch.Tensor(self.cell_fea[idx]), \
-            torch.Tensor([float(target)]), \
-            cif_id
+        return self.storage[idx] + (self.id_prop_data[idx][0],)
+
+
+class PDDStreamData(IterableDataset):
+    """
+    Streaming version of PDDDataNormalized for CIF directories that do not fit in memory. CIFs are
+    read and featurized lazily as the iterator is consumed, split between DataLoader workers and
+    shuffled through a bounded buffer, so memory stays flat and the first batch arrives once the
+    buffer has filled. The dataset options come in PDDDataNormalized's order.
+
+    indices selects rows of the (shuffled) id_prop.csv, which is how the train/val/test streams
+    are kept disjoint, shuffle_items=False keeps the items in that order (validation and test).
+    Items are scaled like PDDDataNormalized's, so a PDDScaler is needed to iterate: load the one
+    saved with a checkpoint or fit one with fit_scaler(), on a sample of the structures or on all
+    of them. New PDDs go to feature_cache, which is evicted every evict_every additions.
+    """
+
+    def __init__(self, filepath, k=15, collapse_tol=1e-4, composition=True, constrained=True, seed=8888,
+                 shuffle=True, collapse=True, *, indices=None, shuffle_buffer=1000, pdd_scaler=None,
+                 feature_cache=None, shuffle_items=True, evict_every=1000):
+        self.filepath = filepath
+        assert os.path.exists(filepath), 'root_dir does not exist!'
+        id_prop_file = os.path.join(self.filepath, 'id_prop.csv')
+        assert os.path.exists(id_prop_file), 'id_prop.csv does not exist!'
+        with open(id_prop_file) as f:
+            reader = csv.reader(f)
+            self.id_prop_data = [row for row in reader]
+        random.seed(seed)
+        if shuffle:
+            random.shuffle(self.id_prop_data)
+        if indices is not None:
+            self.id_prop_data = [self.id_prop_data[i] for i in indices]
+        self.k = int(k)
+        self.collapse_tol = float(collapse_tol)
+        self.composition = composition
+        self.constrained = constrained
+        self.collapse = collapse
+        self.seed = int(seed)
+        self.shuffle = shuffle
+        self.shuffle_items = shuffle_items
+        self.shuffle_buffer = shuffle_buffer
+        self.pdd_scaler = pdd_scaler
+        self.feature_cache = feature_cache
+        self.evict_every = evict_every
+        self._cache_puts = 0
+        self.epoch = 0
+
+    def __len__(self):
+        return len(self.id_prop_data)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _rows(self):
+        rows = list(self.id_prop_data)
+        if self.shuffle_items:
+            random.Random(self.seed + self.epoch).shuffle(rows)
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            rows = rows[worker_info.id::worker_info.num_workers]
+        return rows
+
+    def _featurize(self, ps):
+        key = None
+        if self.feature_cache is not None:
+            key = self.feature_cache.key(ps, self.k, self.collapse_tol, self.constrained, self.collapse)
+            cached = self.feature_cache.get(key)
+            if cached is not None:
+                return cached[0], cached[2]
+        result = _featurize_one(ps, k=self.k, collapse_tol=self.collapse_tol, constrained=self.constrained,
+                                collapse=self.collapse)
+        if key is not None:
+            self.feature_cache.put(key, *result)
+            self._cache_puts += 1
+            if self._cache_puts % self.evict_every == 0:
+                self.feature_cache.evict()
+        return result[0], result[2]
+
+    def fit_scaler(self, max_structures=None):
+        """
+        Fit the PDD scaling on the first max_structures structures of the (shuffled) stream, or on
+        all of them if None, in one pass. Their PDDs go to the feature cache.
+        """
+        scaler = PDDScaler()
+        for cif_id, _ in self.id_prop_data[:max_structures]:
+            scaler.update(self._featurize(AMD.CifReader(os.path.join(self.filepath, cif_id + ".cif")).read())[0])
+        self.pdd_scaler = scaler
+        return scaler
+
+    def _items(self):
+        if self.pdd_scaler is None:
+            raise ValueError("PDDStreamData needs a PDDScaler, call fit_scaler() or pass the one saved with a checkpoint")
+        for cif_id, target in self._rows():
+            ps = AMD.CifReader(os.path.join(self.filepath, cif_id + ".cif")).read()
+            pdd, atom_features = self._featurize(ps)
+            pdd = self.pdd_scaler.transform(pdd)
+            yield torch.Tensor(pdd), \
+                torch.Tensor(atom_features), \
+                torch.Tensor(AMD.cell_to_cellpar(ps.cell)), \
+                torch.Tensor([float(target)]), \
+                cif_id
+
+    def __iter__(self):
+        items = self._items()
+        if not self.shuffle_items or self.shuffle_buffer <= 1:
+            yield from items
+            return
+        worker_info = get_worker_info()
+        rng = random.Random(self.seed + self.epoch + (worker_info.id if worker_info is not None else 0))
+        buffer = []
+        for item in items:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(item)
+                continue
+            i = rng.randrange(len(buffer))
+            buffer[i], item = item, buffer[i]
+            yield item
+        rng.shuffle(buffer)
+        yield from buffer
+
+
+class PDDScaler(object):
+    """
+    Min-max scaling of the PDD distance columns (the weight column is left as is). The range is
+    accumulated one structure at a time, applied per structure when items are loaded and saved
+    with the checkpoint, so new structures can be featurized without the original corpus.
+    """
+
+    def __init__(self, min_pdd=None, max_pdd=None):
+        self.min = min_pdd
+        self.max = max_pdd
+
+    @classmethod
+    def fit(cls, pdds):
+        scaler = cls()
+        for pdd in pdds:
+            scaler.update(pdd)
+        return scaler
+
+    def update(self, pdd):
+        pdd = np.asarray(pdd)
+        if self.min is None:
+            self.min, self.max = np.min(pdd, axis=0), np.max(pdd, axis=0)
+        else:
+            self.min = np.minimum(self.min, np.min(pdd, axis=0))
+            self.max = np.maximum(self.max, np.max(pdd, axis=0))
+
+    def transform(self, pdd):
+        return np.hstack([pdd[:, 0, None], (pdd[:, 1:] - self.min[1:]) / (self.max[1:] - self.min[1:])])
+
+    def state_dict(self):
+        return {'min': torch.from_numpy(self.min),
+                'max': torch.from_numpy(self.max)}
+
+    def load_state_dict(self, state_dict):
+        self.min = np.asarray(state_dict['min'])
+        self.max = np.asarray(state_dict['max'])
 
 
 def preprocess_pdds(pdds_):
-    min_pdd = np.min(np.vstack([np.min(pdd, axis=0) for pdd in pdds_]), axis=0)
-    max_pdd = np.max(np.vstack([np.max(pdd, axis=0) for pdd in pdds_]), axis=0)
-    pdds = [np.hstack(
-        [pdd[:, 0, None], (pdd[:, 1:] - min_pdd[1:]) / (max_pdd[1:] - min_pdd[1:])]) for
-        pdd
-        in pdds_]
-    return pdds
+    scaler = PDDScaler.fit(pdds_)
+    return [scaler.transform(pdd) for pdd in pdds_]
+
+
+class SharedStorage(object):
+    """
+    The items of a featurized dataset packed into float32 tensors: the raw PDD rows and atom
+    types of all structures with their offsets, the cell features and the targets. transform
+    (the PDD scaling) is applied per item as it is loaded. share_memory_() moves the tensors to
+    shared memory, so DataLoader workers read the same pages instead of each receiving a copy.
+    """
+
+    def __init__(self, pdds, atom_fea, cell_fea, targets, transform=None):
+        self.transform = transform
+        self.offsets = np.concatenate([[0], np.cumsum([len(pdd) for pdd in pdds])])
+        self.pdds = torch.empty((int(self.offsets[-1]), pdds[0].shape[1]))
+        self.atom_fea = torch.empty((int(self.offsets[-1]), atom_fea[0].shape[1]))
+        for start, end, pdd, atom_features in zip(self.offsets[:-1], self.offsets[1:], pdds, atom_fea):
+            self.pdds[start:end] = torch.Tensor(pdd)
+            self.atom_fea[start:end] = torch.Tensor(atom_features)
+        self.cell_fea = torch.Tensor(np.asarray(cell_fea, dtype=np.float64))
+        self.targets = torch.Tensor([[float(target)] for target in targets])
+
+    def share_memory_(self):
+        for tensor in (self.pdds, self.atom_fea, self.cell_fea, self.targets):
+            tensor.share_memory_()
+        return self
+
+    def __len__(self):
+        return len(self.targets)
+
+    def rows(self, idx):
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        return self.pdds[start:end], self.atom_fea[start:end]
+
+    def item(self, idx, transform=None):
+        pdd, atom_features = self.rows(idx)
+        if transform is not None:
+            pdd = torch.Tensor(transform(pdd.numpy()))
+        return pdd, atom_features, self.cell_fea[idx], self.targets[idx]
+
+    def __getitem__(self, idx):
+        return self.item(idx, self.transform)
+
+
+def _share_memory(dataset):
+    # Called when the loaders use workers, the stored tensors are then sent to them as shared memory
+    if isinstance(dataset, torch.utils.data.Subset):
+        _share_memory(dataset.dataset)
+    if isinstance(dataset, PDDDataSubset):
+        dataset.targets.share_memory_()
+    if hasattr(dataset, "storage"):
+        dataset.storage.share_memory_()
 
 
 class PDDDataPymatgen(Dataset):
-    def __init__(self, structures, targets, k=15, collapse_tol=1e-4, composition=True, constrained=True, collapse=True):
+    def __init__(self, structures, targets, k=15, collapse_tol=1e-4, composition=True, constrained=True, collapse=True,
+                 workers=None, feature_cache=None,
+                 use_asymmetric_unit=False, pdd_scaler=None):
         k = int(k)
         self.k = k
         self.collapse_tol = float(collapse_tol)
         print(f"tol: {self.collapse_tol}")
         print(f"collapsing: {collapse}")
         self.constrained = constrained
+        self.collapse = collapse
         self.composition = composition
         self.id_prop_data = targets
-        pdds = []
         periodic_sets = [AMD.periodicset_from_pymatgen_structure(s) for s in structures]
         self.cell_fea = [np.concatenate([np.sort(s.lattice.parameters[:3]), np.sort(s.lattice.parameters[3:])]) for s in
                          structures]
-        atom_fea = []
-        motif_sizes = []
-        pdd_sizes = []
-        for i in tqdm(range(len(periodic_sets)),
-                      desc="Creating PDDs…",
-                      ascii=False, ncols=75):
-            ps = periodic_sets[i]
-            motif_sizes.append(ps.motif.shape[0])
-            pdd, groups, inds, _ = custom_PDD(ps, k=self.k, collapse=collapse, collapse_tol=self.collapse_tol,
-                                              constrained=self.constrained, lexsort=False)
-            indices_in_graph = [i[0] for i in groups]
-            atom_features = ps.types[indices_in_graph][:, None]
-            atom_fea.append(atom_features)
-            pdds.append(pdd)
-            pdd_sizes.append(pdd.shape[0])
+        pdds, atom_fea = featurize(periodic_sets, k=self.k, collapse_tol=self.collapse_tol,
+                                   constrained=self.constrained, collapse=collapse, workers=workers,
+                                   cache=feature_cache, use_asymmetric_unit=use_asymmetric_unit)
 
-        self.pdds = preprocess_pdds(pdds)
-        self.atom_fea = atom_fea
+        self.pdd_scaler = pdd_scaler if pdd_scaler is not None else PDDScaler.fit(pdds)
+        self.storage = SharedStorage(pdds, atom_fea, self.cell_fea, self.id_prop_data,
+                                     transform=self.pdd_scaler.transform)
 
     def __len__(self):
         return len(self.id_prop_data)
 
-    @functools.lru_cache(maxsize=None)  # Cache loaded structures
     def __getitem__(self, idx):
-        cif_id, target = self.id_prop_data.index[idx], self.id_prop_data.iloc[idx]
-        return torch.Tensor(self.pdds[idx]), \
-            torch.Tensor(self.atom_fea[idx]), \
-            torch.Tensor(self.cell_fea[idx]), \
-            torch.Tensor([float(target)]), \
-            cif_id
+        return self.storage[idx] + (self.id_prop_data.index[idx],)
+
+
+
+class PDDDataSubset(Dataset):
+    """
+    Index view into a featurized PDDDataPymatgen with its own targets (a Series indexed by
+    the dataset's ids), so splits of the same structures such as Matbench folds share one
+    featurization. The PDD scaler defaults to the parent dataset's.
+    """
+
+    def __init__(self, dataset, targets, pdd_scaler=None):
+        self.dataset = dataset
+        self.id_prop_data = targets
+        self.indices = dataset.id_prop_data.index.get_indexer(targets.index)
+        if (self.indices < 0).any():
+            raise KeyError("targets contain ids that are not in the dataset")
+        self.k = dataset.k
+        self.collapse_tol = dataset.collapse_tol
+        self.constrained = dataset.constrained
+        self.collapse = dataset.collapse
+        self.pdd_scaler = pdd_scaler if pdd_scaler is not None else dataset.pdd_scaler
+        self.targets = torch.Tensor([[float(target)] for target in targets])
+        # Rows are read from the parent's storage, only the targets are new
+        self.storage = dataset.storage
+
+    def __len__(self):
+        return len(self.id_prop_data)
+
+    def __getitem__(self, idx):
+        pdd, atom_features, cell_features, _ = self.storage.item(self.indices[idx], self.pdd_scaler.transform)
+        return pdd, atom_features, cell_features, self.targets[idx], self.id_prop_data.index[idx]
 
 
 import json
 
 class JarvisData2(Dataset):
-    def __init__(self, filepath, prop, k=15, collapse_tol=1e-4, composition=True, constrained=True, collapse=True, shuffle=False):
+    def __init__(self, filepath, prop, k=15, collapse_tol=1e-4, composition=True, constrained=True, collapse=True, shuffle=False,
+                 workers=None, feature_cache=None,
+                 use_asymmetric_unit=False, pdd_scaler=None):
         structures, props, jids = pickle.load(open(filepath, "rb"))
 
         targets = list(props[prop])
@@ -340,6 +786,7 @@ class JarvisData2(Dataset):
         self.k = int(k)
         self.collapse_tol = float(collapse_tol)
         self.constrained = constrained
+        self.collapse = collapse
         self.composition = composition
 
         if not shuffle:
@@ -362,64 +809,104 @@ class JarvisData2(Dataset):
 
         self.jids = jids
         self.id_prop_data = targets
-        pdds = []
         cache_file = os.path.basename(filepath) + "_ps"
         periodic_sets = [AMD.periodicset_from_pymatgen_structure(s) for s in structures]
 
         self.cell_fea = [np.concatenate([np.sort(s.lattice.parameters[:3]), np.sort(s.lattice.parameters[3:])]) for s in
                          structures]
-        atom_fea = []
-        for i in tqdm(range(len(periodic_sets)),
-                      desc="Creating PDDs…",
-                      ascii=False, ncols=75):
-            ps = periodic_sets[i]
-            pdd, groups, inds, _ = custom_PDD(ps, k=self.k, collapse=collapse, collapse_tol=self.collapse_tol,
-                                              constrained=self.constrained, lexsort=False)
-            indices_in_graph = [i[0] for i in groups]
-            atom_features = ps.types[indices_in_graph][:, None]
-            atom_fea.append(atom_features)
-            pdds.append(pdd)
+        pdds, atom_fea = featurize(periodic_sets, k=self.k, collapse_tol=self.collapse_tol,
+                                   constrained=self.constrained, collapse=collapse, workers=workers,
+                                   cache=feature_cache, use_asymmetric_unit=use_asymmetric_unit)
 
-        self.pdds = preprocess_pdds(pdds)
-        self.atom_fea = atom_fea
+        self.pdd_scaler = pdd_scaler if pdd_scaler is not None else PDDScaler.fit(pdds)
+        self.storage = SharedStorage(pdds, atom_fea, self.cell_fea, self.id_prop_data,
+                                     transform=self.pdd_scaler.transform)
 
     def __len__(self):
         return len(self.id_prop_data)
 
-    @functools.lru_cache(maxsize=None)  # Cache loaded structures
     def __getitem__(self, idx):
-        cif_id, target = self.jids[idx], self.id_prop_data[idx]
-        return torch.Tensor(self.pdds[idx]), \
-            torch.Tensor(self.atom_fea[idx]), \
-            torch.Tensor(self.cell_fea[idx]), \
-            torch.Tensor([float(target)]), \
-            cif_id
+        return self.storage[idx] + (self.jids[idx],)
+
+
+
+@functools.lru_cache(maxsize=None)
+def _atomic_numbers():
+    pt = pd.read_csv("periodic_table.csv")
+    return dict(zip(pt["Symbol"], pt["AtomicNumber"].astype(int)))
 
 
+def periodicset_from_jarvis_atoms(atoms):
+    """Build a PeriodicSet straight from a JARVIS atoms dict, without going through pymatgen"""
+    cell = np.array(atoms["lattice_mat"], dtype=np.float64)
+    motif = np.array(atoms["coords"], dtype=np.float64)
+    if not atoms["cartesian"]:
+        motif = motif @ cell
+    atomic_numbers = _atomic_numbers()
+    types = np.array([atomic_numbers[e] for e in atoms["elements"]])
+    return AMD.PeriodicSet(motif, cell, types=types)
+
+
+class JarvisFeatures(object):
+    """
+    Featurizes every dft_3d structure that has a value for at least one of props, once. JarvisData
+    built with features= are index views into these lists, so training several properties does
+    not reconvert or refeaturize the shared structures.
+    """
+
+    def __init__(self, props, k=15, collapse_tol=1e-4, constrained=True, workers=None, feature_cache=None,
+                 use_asymmetric_unit=False, jarvis_data=None):
+        d = jarvis_data if jarvis_data is not None else jdata("dft_3d_2021")
+        to_keep = [i for i, entry in enumerate(d) if any(entry[prop] != "na" for prop in props)]
+        self.k = int(k)
+        self.collapse_tol = float(collapse_tol)
+        self.jids = [d[i]['jid'] for i in to_keep]
+        self.targets = {prop: [d[i][prop] for i in to_keep] for prop in props}
+        print(f"Featurizing {len(to_keep)} structures for {len(props)} properties")
+
+        periodic_sets = [periodicset_from_jarvis_atoms(d[i]['atoms']) for i in to_keep]
+        cellpars = [AMD.cell_to_cellpar(ps.cell) for ps in periodic_sets]
+        self.cell_fea = [np.concatenate([np.sort(c[:3]), np.sort(c[3:])]) for c in cellpars]
+        self.pdds, self.atom_fea = featurize(periodic_sets, k=self.k, collapse_tol=self.collapse_tol,
+                                             constrained=constrained, collapse=True, workers=workers,
+                                             cache=feature_cache, use_asymmetric_unit=use_asymmetric_unit)
+
 
 class JarvisData(Dataset):
-    def __init__(self, prop, k=15, collapse_tol=1e-4, composition=True, constrained=True, collapse=True, shuffle=False):
-        d = jdata("dft_3d_2021")
-        #d = jdata('dft_3d')
-        jids = [i['jid'] for i in d]
-        targets = [i[prop] for i in d]
-        structures = [Atoms.from_dict(i['atoms']).pymatgen_converter() for i in d]
+    """
+    jarvis_data (the loaded dft_3d list) and periodic_sets (a jid -> PeriodicSet dict that is
+    filled as structures are converted) can be shared between properties to avoid reloading
+    and reconverting the database. With features (a JarvisFeatures covering prop) nothing is
+    featurized and the dataset only selects and orders the shared structures.
+    """
+
+    def __init__(self, prop, k=15, collapse_tol=1e-4, composition=True, constrained=True, collapse=True, shuffle=False,
+                 workers=None, feature_cache=None,
+                 use_asymmetric_unit=False, pdd_scaler=None, jarvis_data=None, periodic_sets=None, features=None):
+        if features is not None:
+            jids = features.jids
+            targets = features.targets[prop]
+        else:
+            d = jarvis_data if jarvis_data is not None else jdata("dft_3d_2021")
+            #d = jdata('dft_3d')
+            jids = [i['jid'] for i in d]
+            targets = [i[prop] for i in d]
 
         to_keep = [i for i in range(len(targets)) if targets[i] != "na"]
         if shuffle:
             random.seed(123)
             random.shuffle(to_keep)
         else:
-            test_ids = json.load(open(f"./mf/{prop}/ids_train_val_test.json", "r"))["id_test"]
+            test_ids = set(json.load(open(f"./mf/{prop}/ids_train_val_test.json", "r"))["id_test"])
 
         print(f"Dataset of size: {len(to_keep)}")
-        structures = [structures[i] for i in to_keep]
         targets = [float(targets[i]) for i in to_keep]
         jids = [jids[i] for i in to_keep]
 
         self.k = int(k)
         self.collapse_tol = float(collapse_tol)
         self.constrained = constrained
+        self.collapse = True
         self.composition = composition
 
         if not shuffle:
@@ -435,50 +922,243 @@ class JarvisData(Dataset):
             print(f"Train size: {len(train_inds)}")
             print(f"Test size: {len(test_inds)}")
             ordered_inds = train_inds + test_inds
-            structures = [structures[i] for i in ordered_inds]
+            to_keep = [to_keep[i] for i in ordered_inds]
             targets = [targets[i] for i in ordered_inds]
             jids = [jids[i] for i in ordered_inds]
 
         self.jids = jids
         self.id_prop_data = targets
-        pdds = []
-        periodic_sets = [AMD.periodicset_from_pymatgen_structure(s) for s in structures]
-
-        self.cell_fea = [np.concatenate([np.sort(s.lattice.parameters[:3]), np.sort(s.lattice.parameters[3:])]) for s in
-                         structures]
-        atom_fea = []
-        for i in tqdm(range(len(periodic_sets)),
-                      desc="Creating PDDs…",
-                      ascii=False, ncols=75):
-            ps = periodic_sets[i]
-            pdd, groups, inds, cloud = custom_PDD(ps, k=self.k, collapse=True, collapse_tol=self.collapse_tol,
-                                              constrained=self.constrained, lexsort=False)
+        if features is not None:
+            self.k = features.k
+            self.collapse_tol = features.collapse_tol
+            self.cell_fea = [features.cell_fea[i] for i in to_keep]
+            pdds = [features.pdds[i] for i in to_keep]
+            atom_fea = [features.atom_fea[i] for i in to_keep]
+        else:
+            if periodic_sets is None:
+                periodic_sets = {}
+            for jid, i in zip(jids, to_keep):
+                if jid not in periodic_sets:
+                    periodic_sets[jid] = periodicset_from_jarvis_atoms(d[i]['atoms'])
+            periodic_sets = [periodic_sets[jid] for jid in jids]
+
+            cellpars = [AMD.cell_to_cellpar(ps.cell) for ps in periodic_sets]
+            self.cell_fea = [np.concatenate([np.sort(c[:3]), np.sort(c[3:])]) for c in cellpars]
+            pdds, atom_fea = featurize(periodic_sets, k=self.k, collapse_tol=self.collapse_tol,
+                                       constrained=self.constrained, collapse=True, workers=workers,
+                                       cache=feature_cache, use_asymmetric_unit=use_asymmetric_unit)
+
+        self.pdd_scaler = pdd_scaler if pdd_scaler is not None else PDDScaler.fit(pdds)
+        self.storage = SharedStorage(pdds, atom_fea, self.cell_fea, self.id_prop_data,
+                                     transform=self.pdd_scaler.transform)
 
-            indices_in_graph = [i[0] for i in groups]
-            atom_features = ps.types[indices_in_graph][:, None]
-            atom_fea.append(atom_features)
-            pdds.append(pdd)
+    def __len__(self):
+        return len(self.id_prop_data)
 
-        self.pdds = preprocess_pdds(pdds)
-        self.atom_fea = atom_fea
+    def __getitem__(self, idx):
+        return self.storage[idx] + (self.jids[idx],)
+
+
+def _id_prop_sha1(filepath):
+    with open(os.path.join(filepath, 'id_prop.csv'), 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def feature_store_meta(k, collapse_tol, constrained, collapse, filepath=None, seed=None, shuffle=None):
+    """
+    The settings saved with a feature store, a store is only reused when they match: the
+    featurization, and for datasets read from a directory its path, the contents of its
+    id_prop.csv and the seed and shuffle that order the structures (and so the splits)
+    """
+    meta = {"version": FEATURE_VERSION, "k": int(k), "collapse_tol": float(collapse_tol),
+            "constrained": bool(constrained), "collapse": bool(collapse)}
+    if filepath is not None:
+        meta.update(filepath=os.path.abspath(filepath), id_prop_sha1=_id_prop_sha1(filepath),
+                    seed=seed, shuffle=bool(shuffle))
+    return meta
+
+
+def data_options_meta(*data_options):
+    """feature_store_meta of the PDDDataNormalized that main.py builds from its dataset options"""
+    options = inspect.signature(PDDDataNormalized).bind(*data_options)
+    options.apply_defaults()
+    options = options.arguments
+    return feature_store_meta(options["k"], options["collapse_tol"], options["constrained"], options["collapse"],
+                              filepath=options["filepath"], seed=options["seed"], shuffle=options["shuffle"])
+
+
+def _stored_scaler(path):
+    if not os.path.exists(os.path.join(path, "pdd_scaler.pth")):
+        return None
+    pdd_scaler = PDDScaler()
+    pdd_scaler.load_state_dict(torch.load(os.path.join(path, "pdd_scaler.pth")))
+    return pdd_scaler
+
+
+def feature_store_mismatch(path, meta, pdd_scaler=None):
+    """
+    Why the feature store at path cannot be used for features built with meta (and scaled
+    with pdd_scaler, e.g. the one of a resumed checkpoint), None if it can
+    """
+    stored_meta = read_feature_store_meta(path)
+    if stored_meta != meta:
+        return f"it was built with {stored_meta}, expected {meta}"
+    if pdd_scaler is not None:
+        stored_scaler = _stored_scaler(path)
+        if stored_scaler is None or not (np.allclose(stored_scaler.min, pdd_scaler.min)
+                                         and np.allclose(stored_scaler.max, pdd_scaler.max)):
+            return "its PDDs were scaled with a different PDDScaler"
+    return None
+
+
+def pack_dataset(dataset, path):
+    """Write a featurized dataset (with a SharedStorage) to a packed feature store"""
+    getitem = getattr(type(dataset).__getitem__, "__wrapped__", type(dataset).__getitem__)  # skip any lru_cache
+    targets, ids = [], []
+    for idx in range(len(dataset)):
+        _, _, _, target, cif_id = getitem(dataset, idx)
+        targets.append(float(target))
+        ids.append(cif_id)
+    pdd_scaler = getattr(dataset, "pdd_scaler", None)
+    rows = [dataset.storage.rows(idx) for idx in range(len(dataset))]
+    write_feature_store(path, [pdd.numpy() for pdd, _ in rows], [atom_features.numpy() for _, atom_features in rows],
+                        dataset.storage.cell_fea.numpy(), targets, ids,
+                        transform=pdd_scaler.transform if pdd_scaler is not None else None,
+                        meta=feature_store_meta(dataset.k, dataset.collapse_tol, dataset.constrained, dataset.collapse,
+                                                filepath=getattr(dataset, "filepath", None),
+                                                seed=getattr(dataset, "seed", None),
+                                                shuffle=getattr(dataset, "shuffle", None)))
+    if pdd_scaler is not None:
+        torch.save(pdd_scaler.state_dict(), os.path.join(path, "pdd_scaler.pth"))
+
+
+class PackedPDDData(Dataset):
+    """
+    Dataset over a feature store written by pack_dataset, items are zero-copy slices of the memmaps.
+    With meta (and pdd_scaler) the store is checked against the expected featurization (and scaling)
+    and refused with a ValueError if it was built differently.
+    """
+
+    def __init__(self, path, meta=None, pdd_scaler=None):
+        assert os.path.exists(path), 'feature store does not exist!'
+        if meta is not None:
+            mismatch = feature_store_mismatch(path, meta, pdd_scaler)
+            if mismatch is not None:
+                raise ValueError(f"feature store {path} does not match the dataset options: {mismatch}")
+        self.store = FeatureStore(path)
+        self.pdd_scaler = _stored_scaler(path)  # already applied to the stored rows
 
     def __len__(self):
-        return len(self.id_prop_data)
+        return len(self.store)
 
-    @functools.lru_cache(maxsize=None)  # Cache loaded structures
     def __getitem__(self, idx):
-        cif_id, target = self.jids[idx], self.id_prop_data[idx]
-        return torch.Tensor(self.pdds[idx]), \
-            torch.Tensor(self.atom_fea[idx]), \
-            torch.Tensor(self.cell_fea[idx]), \
-            torch.Tensor([float(target)]), \
-            cif_id
+        rows = self.store.rows(idx)
+        return torch.from_numpy(self.store.pdds[rows]), \
+            torch.from_numpy(self.store.atom_fea[rows]), \
+            torch.from_numpy(self.store.cell_fea[idx]), \
+            torch.from_numpy(self.store.targets[idx:idx + 1]), \
+            self.store.ids[idx]
+
+
+
+class ResidentTensors(object):
+    """
+    A whole dataset packed once into contiguous tensors: the PDD rows and atom types of all
+    structures with their offsets, plus the cell features, targets and ids. batch() gathers a
+    padded (as collate_pool) or packed (as collate_packed) batch by tensor indexing, without
+    building per-item tensors.
+    """
+
+    def __init__(self, dataset):
+        if isinstance(dataset, PackedPDDData):
+            store = dataset.store
+            self.pdds = torch.from_numpy(np.ascontiguousarray(store.pdds))
+            self.atom_fea = torch.from_numpy(np.ascontiguousarray(store.atom_fea))
+            self.cell_fea = torch.from_numpy(np.ascontiguousarray(store.cell_fea))
+            self.targets = torch.from_numpy(np.ascontiguousarray(store.targets))[:, None]
+            self.offsets = torch.from_numpy(store.offsets)
+            self.ids = list(store.ids)
+            return
+        getitem = getattr(type(dataset).__getitem__, "__wrapped__", type(dataset).__getitem__)  # skip any lru_cache
+        pdds, atom_fea, cell_fea, targets, self.ids = [], [], [], [], []
+        for idx in range(len(dataset)):
+            pdd, atom_features, cell_features, target, cif_id = getitem(dataset, idx)
+            pdds.append(pdd)
+            atom_fea.append(atom_features)
+            cell_fea.append(cell_features)
+            targets.append(target)
+            self.ids.append(cif_id)
+        self.pdds = torch.cat(pdds, dim=0)
+        self.atom_fea = torch.cat(atom_fea, dim=0)
+        self.cell_fea = torch.stack(cell_fea, dim=0)
+        self.targets = torch.stack(targets, dim=0)
+        self.offsets = torch.cat([torch.zeros(1, dtype=torch.long),
+                                  torch.cumsum(torch.tensor([len(pdd) for pdd in pdds]), dim=0)])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def batch(self, idx, packed=False):
+        idx = torch.as_tensor(idx, dtype=torch.long)
+        starts = self.offsets[idx]
+        seqlens = self.offsets[idx + 1] - starts
+        if packed:
+            cu_seqlens = torch.cat([seqlens.new_zeros(1), torch.cumsum(seqlens, dim=0)])
+            batch_index = torch.repeat_interleave(torch.arange(len(idx)), seqlens)
+            rows = starts[batch_index] + torch.arange(int(cu_seqlens[-1])) - cu_seqlens[batch_index]
+            inputs = (self.pdds[rows], self.atom_fea[rows], self.cell_fea[idx], cu_seqlens, batch_index)
+        else:
+            positions = torch.arange(int(seqlens.max()))
+            real = positions[None, :] < seqlens[:, None]  # b, n
+            rows = torch.where(real, starts[:, None] + positions[None, :], 0)
+            inputs = (self.pdds[rows] * real[:, :, None], self.atom_fea[rows] * real[:, :, None], self.cell_fea[idx])
+        return inputs, self.targets[idx], [self.ids[i] for i in idx.tolist()]
+
+
+class ResidentLoader(object):
+    """
+    Drop-in replacement for the DataLoader over a dataset: yields the same (inputs, target, ids)
+    batches as collate_pool (or collate_packed with packed=True) from ResidentTensors. Batches are
+    formed from a sampler of indices in batch_size steps, or taken from a batch_sampler.
+    """
+
+    def __init__(self, tensors, sampler=None, batch_size=64, batch_sampler=None, packed=False, pin_memory=False):
+        self.tensors = tensors
+        self.sampler = sampler if sampler is not None else range(len(tensors))
+        self.batch_size = batch_size
+        self.batch_sampler = batch_sampler
+        self.packed = packed
+        # As DataLoader, pinning is skipped with a warning when there is no GPU
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        if pin_memory and not self.pin_memory:
+            warnings.warn("pin_memory is set but no GPU is available, batches will not be pinned")
+
+    def _batches(self):
+        if self.batch_sampler is not None:
+            yield from self.batch_sampler
+            return
+        indices = list(self.sampler)
+        for start in range(0, len(indices), self.batch_size):
+            yield indices[start:start + self.batch_size]
+
+    def __iter__(self):
+        for idx in self._batches():
+            inputs, target, ids = self.tensors.batch(idx, packed=self.packed)
+            if self.pin_memory:
+                inputs, target = [t.pin_memory() for t in inputs], target.pin_memory()
+            yield inputs, target, ids
+
+    def __len__(self):
+        if self.batch_sampler is not None:
+            return len(self.batch_sampler)
+        return -(-len(self.sampler) // self.batch_size)
 
 
 class LMDBData(Dataset):
 
     def __init__(self, path, property="total_energy", k=60, collapse_tol=1e-4, composition=True, constrained=True,
-                 preprocess=True, collapse=True, cache=True):
+                 preprocess=True, collapse=True, cache=True, workers=None, feature_cache=None,
+                 use_asymmetric_unit=False):
         k = int(k)
         self.k = k
         self.collapse_tol = float(collapse_tol)
@@ -531,17 +1211,10 @@ class LMDBData(Dataset):
         self.cell_fea = cell_fea
         print("")
         if preprocess:
-            i = 0
-            for ps in periodic_sets:
-                sys.stdout.write("PDD Creation progress: %.2f%%   \r" % np.round(i / len(targets) * 100, 2))
-                sys.stdout.flush()
-                pdd, groups, inds, _ = custom_PDD(ps, k=self.k, collapse=collapse, collapse_tol=self.collapse_tol,
-                                                  constrained=self.constrained, lexsort=False)
-                indices_in_graph = [i[0] for i in groups]
-                atom_features = ps.types[indices_in_graph][:, None]
-                pdd = np.hstack([pdd, atom_features])
-                pdds.append(pdd)
-                i += 1
+            pdds, atom_fea = featurize(periodic_sets, k=self.k, collapse_tol=self.collapse_tol,
+                                       constrained=self.constrained, collapse=collapse, workers=workers,
+                                       cache=feature_cache, use_asymmetric_unit=use_asymmetric_unit)
+            pdds = [np.hstack([pdd, atom_features]) for pdd, atom_features in zip(pdds, atom_fea)]
 
             min_pdd = np.min(np.vstack([np.min(pdd, axis=0) for pdd in pdds]), axis=0)
             max_pdd = np.max(np.vstack([np.max(pdd, axis=0) for pdd in pdds]), axis=0)
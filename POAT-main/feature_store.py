@@ -0,0 +1,85 @@
+import json
+import os
+
+import numpy as np
+
+FILES = ("pdds.npy", "atom_fea.npy", "offsets.npy", "cell_fea.npy", "targets.npy", "ids.json")
+
+
+def _to_builtin(x):
+    return x.item() if isinstance(x, np.generic) else x
+
+
+def write_feature_store(path, pdds, atom_fea, cell_fea, targets, ids, transform=None, meta=None):
+    """
+    Pack the per-structure arrays into one contiguous float32 array of PDD rows
+    (and atom types) with an offsets index, plus the cell features, targets and
+    ids. The rows are written straight into .npy memmaps (after transform, if
+    given), so no second copy of the dataset is held in memory. meta (a dict of
+    the featurization settings) is saved alongside so readers can check it.
+    """
+    os.makedirs(path, exist_ok=True)
+    row_counts = np.array([pdd.shape[0] for pdd in pdds], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(row_counts)])
+    total, n_features = int(offsets[-1]), pdds[0].shape[1]
+
+    packed_pdds = np.lib.format.open_memmap(os.path.join(path, "pdds.npy"), mode="w+",
+                                            dtype=np.float32, shape=(total, n_features))
+    packed_atom_fea = np.lib.format.open_memmap(os.path.join(path, "atom_fea.npy"), mode="w+",
+                                                dtype=np.float32, shape=(total, atom_fea[0].shape[1]))
+    for start, end, pdd, atom_features in zip(offsets[:-1], offsets[1:], pdds, atom_fea):
+        packed_pdds[start:end] = transform(pdd) if transform is not None else pdd
+        packed_atom_fea[start:end] = atom_features
+    packed_pdds.flush()
+    packed_atom_fea.flush()
+    del packed_pdds, packed_atom_fea
+
+    np.save(os.path.join(path, "offsets.npy"), offsets)
+    np.save(os.path.join(path, "cell_fea.npy"), np.asarray(cell_fea, dtype=np.float32))
+    np.save(os.path.join(path, "targets.npy"), np.asarray(targets, dtype=np.float32))
+    with open(os.path.join(path, "ids.json"), "w") as f:
+        json.dump([_to_builtin(i) for i in ids], f)
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+
+def feature_store_exists(path):
+    return all(os.path.exists(os.path.join(path, f)) for f in FILES)
+
+
+def read_feature_store_meta(path):
+    """The meta a store was written with, None for stores written without one"""
+    meta_file = os.path.join(path, "meta.json")
+    if not os.path.exists(meta_file):
+        return None
+    with open(meta_file) as f:
+        return json.load(f)
+
+
+class FeatureStore(object):
+    """
+    Read side of write_feature_store. The arrays are opened as copy-on-write
+    memmaps: slicing them is zero-copy, pages are shared by every process that
+    opens the store and nothing is read until it is used.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pdds = np.load(os.path.join(path, "pdds.npy"), mmap_mode="c")
+        self.atom_fea = np.load(os.path.join(path, "atom_fea.npy"), mmap_mode="c")
+        self.cell_fea = np.load(os.path.join(path, "cell_fea.npy"), mmap_mode="c")
+        self.targets = np.load(os.path.join(path, "targets.npy"), mmap_mode="c")
+        self.offsets = np.load(os.path.join(path, "offsets.npy"))
+        with open(os.path.join(path, "ids.json")) as f:
+            self.ids = json.load(f)
+        self.meta = read_feature_store_meta(path)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def rows(self, idx):
+        return slice(self.offsets[idx], self.offsets[idx + 1])
+
+    @property
+    def row_counts(self):
+        return np.diff(self.offsets)
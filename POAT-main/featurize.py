@@ -0,0 +1,223 @@
+import hashlib
+import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+from tqdm import tqdm
+
+from pdd_helpers import custom_PDD, extract_motif_cell, neighbour_query
+
+# Bump whenever custom_PDD changes its output so that old cache entries are ignored
+FEATURE_VERSION = 1
+
+
+def _featurize_one(ps, k=15, collapse_tol=1e-4, constrained=True, collapse=True, collapse_method="auto",
+                   use_asymmetric_unit=False, neighbours=None):
+    pdd, groups, inds, _ = custom_PDD(ps, k=k, collapse=collapse, collapse_tol=collapse_tol,
+                                      constrained=constrained, lexsort=False, collapse_method=collapse_method,
+                                      use_asymmetric_unit=use_asymmetric_unit, neighbours=neighbours)
+    indices_in_graph = [i[0] for i in groups]
+    atom_features = ps.types[indices_in_graph][:, None]
+    return pdd, groups, atom_features
+
+
+def featurize_periodic_set(ps, k=15, collapse_tol=1e-4, constrained=True, collapse=True, collapse_method="auto",
+                           use_asymmetric_unit=False):
+    pdd, _, atom_features = _featurize_one(ps, k=k, collapse_tol=collapse_tol, constrained=constrained,
+                                           collapse=collapse, collapse_method=collapse_method,
+                                           use_asymmetric_unit=use_asymmetric_unit)
+    return pdd, atom_features
+
+
+class FeatureCache(object):
+    """
+    Content-addressed on-disk store of featurized structures. Each entry holds
+    the PDD rows, row groups and atom types of one structure and is keyed by a
+    hash of the structure and the featurization parameters. Entries are evicted
+    least recently used first once the cache grows past max_size bytes.
+    """
+
+    def __init__(self, root="./feature_cache", max_size=4 * 1024 ** 3):
+        self.root = root
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def key(ps, k, collapse_tol, constrained, collapse, use_asymmetric_unit=False):
+        motif, cell, _, _ = extract_motif_cell(ps)
+        h = hashlib.sha1()
+        h.update(np.ascontiguousarray(cell, dtype=np.float64).tobytes())
+        h.update(np.ascontiguousarray(motif, dtype=np.float64).tobytes())
+        h.update(np.ascontiguousarray(ps.types, dtype=np.int64).tobytes())
+        h.update(repr((FEATURE_VERSION, int(k), float(collapse_tol), bool(constrained), bool(collapse),
+                       bool(use_asymmetric_unit))).encode())
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key + ".npz")
+
+    def get(self, key):
+        path = self._path(key)
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+        try:
+            with np.load(path) as entry:
+                if int(entry["version"]) != FEATURE_VERSION:
+                    raise ValueError("stale cache entry")
+                pdd, atom_features = entry["pdd"], entry["atom_fea"]
+                group_rows, group_offsets = entry["group_rows"], entry["group_offsets"]
+        except Exception:
+            # Corrupt or stale entries are dropped and recomputed
+            self._remove(path)
+            self.misses += 1
+            return None
+        os.utime(path)  # mark as recently used for eviction
+        self.hits += 1
+        groups = [list(g) for g in np.split(group_rows, group_offsets[1:-1])]
+        return pdd, groups, atom_features
+
+    def put(self, key, pdd, groups, atom_features):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        group_offsets = np.cumsum([0] + [len(g) for g in groups])
+        group_rows = np.concatenate([np.asarray(g, dtype=np.int64) for g in groups])
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, version=FEATURE_VERSION, pdd=pdd, atom_fea=atom_features,
+                     group_rows=group_rows, group_offsets=group_offsets)
+        os.replace(tmp_path, path)
+
+    def _entries(self):
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith(".npz"):
+                    path = os.path.join(dirpath, filename)
+                    stat = os.stat(path)
+                    yield stat.st_mtime, stat.st_size, path
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            self._remove(path)
+            total -= size
+
+    def clear(self):
+        for _, _, path in list(self._entries()):
+            self._remove(path)
+
+
+def featurize(periodic_sets, k=15, collapse_tol=1e-4, constrained=True, collapse=True,
+              workers=None, chunksize=32, cache=None, collapse_method="auto", use_asymmetric_unit=False,
+              desc="Creating PDDs…"):
+    """
+    Compute the PDD and atom types of every periodic set, spreading the calls
+    to custom_PDD over a process pool. Results are returned in input order, so
+    they are identical to running featurize_periodic_set in a loop.
+
+    workers=None uses every available core, workers <= 1 runs serially. When a
+    FeatureCache is given only structures missing from it are computed. Both
+    collapse methods of custom_PDD give the same groups, "kdtree" avoids the
+    quadratic pdist matrices on large motifs and "auto" uses it only above 300
+    rows, where it becomes the faster one. use_asymmetric_unit merges the rows of
+    each symmetry orbit of the reader's asymmetric unit before the collapse, where
+    they agree as the full collapse requires.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    k, collapse_tol = int(k), float(collapse_tol)
+    fn = partial(_featurize_one, k=k, collapse_tol=collapse_tol, constrained=constrained,
+                 collapse=collapse, collapse_method=collapse_method, use_asymmetric_unit=use_asymmetric_unit)
+
+    results = [None] * len(periodic_sets)
+    if cache is not None:
+        keys = [cache.key(ps, k, collapse_tol, constrained, collapse, use_asymmetric_unit) for ps in periodic_sets]
+        results = [cache.get(key) for key in keys]
+    to_compute = [i for i, r in enumerate(results) if r is None]
+    progress = dict(total=len(to_compute), desc=desc, ascii=False, ncols=75)
+    missing = [periodic_sets[i] for i in to_compute]
+
+    if workers <= 1 or len(missing) <= chunksize:
+        computed = [fn(ps) for ps in tqdm(missing, **progress)]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            computed = list(tqdm(executor.map(fn, missing, chunksize=chunksize), **progress))
+
+    for i, r in zip(to_compute, computed):
+        results[i] = r
+        if cache is not None:
+            cache.put(keys[i], *r)
+    if cache is not None and computed:
+        cache.evict()
+
+    pdds = [pdd for pdd, _, _ in results]
+    atom_fea = [atom_features for _, _, atom_features in results]
+    return pdds, atom_fea
+
+
+def _featurize_grid_one(ps, params=(), constrained=True, collapse=True, collapse_method="auto",
+                        use_asymmetric_unit=False):
+    # Orbits merged at the smallest tolerance and the largest k also collapse at every other grid point
+    neighbours = neighbour_query(ps, max(k for k, _ in params), use_asymmetric_unit=use_asymmetric_unit and collapse,
+                                 collapse_tol=min(collapse_tol for _, collapse_tol in params), constrained=constrained)
+    return [_featurize_one(ps, k=k, collapse_tol=collapse_tol, constrained=constrained, collapse=collapse,
+                           collapse_method=collapse_method, use_asymmetric_unit=use_asymmetric_unit,
+                           neighbours=neighbours)
+            for k, collapse_tol in params]
+
+
+def featurize_grid(periodic_sets, ks, collapse_tols, constrained=True, collapse=True, workers=None, chunksize=32,
+                   cache=None, collapse_method="auto", use_asymmetric_unit=False, desc="Creating PDDs…"):
+    """
+    Featurize every combination of k and collapse_tol with a single neighbour query per
+    structure at max(ks): smaller k are slices of it and each tolerance only re-runs the
+    row grouping. Returns {(k, collapse_tol): (pdds, atom_fea)}. With a FeatureCache every
+    variant is stored, so datasets built later for any point of the grid load from the cache.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    params = [(int(k), float(collapse_tol)) for k in ks for collapse_tol in collapse_tols]
+    fn = partial(_featurize_grid_one, params=params, constrained=constrained, collapse=collapse,
+                 collapse_method=collapse_method, use_asymmetric_unit=use_asymmetric_unit)
+
+    results = [None] * len(periodic_sets)
+    if cache is not None:
+        keys = [[cache.key(ps, k, collapse_tol, constrained, collapse, use_asymmetric_unit) for k, collapse_tol in params]
+                for ps in periodic_sets]
+        for i, structure_keys in enumerate(keys):
+            cached = [cache.get(key) for key in structure_keys]
+            if all(r is not None for r in cached):
+                results[i] = cached
+    to_compute = [i for i, r in enumerate(results) if r is None]
+    progress = dict(total=len(to_compute), desc=desc, ascii=False, ncols=75)
+    missing = [periodic_sets[i] for i in to_compute]
+
+    if workers <= 1 or len(missing) <= chunksize:
+        computed = [fn(ps) for ps in tqdm(missing, **progress)]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            computed = list(tqdm(executor.map(fn, missing, chunksize=chunksize), **progress))
+
+    for i, r in zip(to_compute, computed):
+        results[i] = r
+        if cache is not None:
+            for key, variant in zip(keys[i], r):
+                cache.put(key, *variant)
+    if cache is not None and computed:
+        cache.evict()
+
+    return {param: ([r[j][0] for r in results], [r[j][2] for r in results]) for j, param in enumerate(params)}
@@ -24,6 +24,8 @@ from train import *
 
 from data import *
 from model import PeriodicSetTransformer
+from featurize import FeatureCache
+from feature_store import feature_store_exists
 
 parser = argparse.ArgumentParser(description='Periodic Set Transformer')
 parser.add_argument('data_options', metavar='OPTIONS', nargs='+',
@@ -33,12 +35,32 @@ parser.add_argument('--disable-cuda', action='store_true',
                     help='Disable CUDA')
 parser.add_argument('-j', '--workers', default=0, type=int, metavar='N',
                     help='number of data loading workers (default: 0)')
+parser.add_argument('--featurize-workers', default=None, type=int, metavar='N',
+                    help='number of processes used to create the PDDs (default: all cores)')
+parser.add_argument('--feature-cache', default='./feature_cache', type=str, metavar='PATH',
+                    help='directory of the on-disk PDD cache, empty to disable (default: ./feature_cache)')
+parser.add_argument('--feature-store', default='', type=str, metavar='PATH',
+                    help='packed feature store to load the dataset from, written on the first run and '
+                         'rebuilt when it does not match the dataset options or the resumed PDD scaler '
+                         '(default: none)')
+parser.add_argument('--stream', action='store_true',
+                    help='featurize the CIFs lazily while training instead of loading the whole dataset, '
+                         'for directories that do not fit in memory')
+parser.add_argument('--scaler-sample', default=1000, type=int, metavar='N',
+                    help='with --stream, fit the PDD scaler on the first N structures before training, '
+                         '0 for all of them (default: 1000)')
 parser.add_argument('--epochs', default=200, type=int, metavar='N',
                     help='number of total epochs to run (default: 200)')
 parser.add_argument('--start-epoch', default=0, type=int, metavar='N',
                     help='manual epoch number (useful on restarts)')
 parser.add_argument('-b', '--batch-size', default=64, type=int,
                     metavar='N', help='mini-batch size (default: 32)')
+parser.add_argument('--bucket-size', default=0, type=int, metavar='N',
+                    help='batch structures of similar size, sorting chunks of N batches by '
+                         'PDD row count (default: 0, random batches)')
+parser.add_argument('--max-tokens', default=0, type=int, metavar='N',
+                    help='size batches by a budget of N padded PDD rows (structures x largest '
+                         'row count) instead of --batch-size (default: 0, fixed batch size)')
 parser.add_argument('--lr', '--learning-rate', default=0.0001, type=float,
                     metavar='LR', help='initial learning rate (default: '
                                        '0.0001)')
@@ -85,6 +107,19 @@ parser.add_argument('--disable-composition', action='store_true',
                     help='Disable atomic composition')
 parser.add_argument('--disable-pdd-encoding', action='store_true',
                     help='Disable PDD Encoding')
+parser.add_argument('--mask-padding', action='store_true',
+                    help='Exclude padded PDD rows from attention and batch norm')
+parser.add_argument('--packed', action='store_true',
+                    help='batch the concatenated PDD rows of the structures instead of padding them')
+parser.add_argument('--resident', action='store_true',
+                    help='pack the whole dataset into tensors once and gather batches from them')
+parser.add_argument('--prefetch', action='store_true',
+                    help='prepare the next batch on a background thread while the current one trains')
+parser.add_argument('--fuse-embedding', action='store_true',
+                    help='outside training look up projected atom embeddings from a precomputed table')
+parser.add_argument('--attention', default='bmm', type=str, choices=['bmm', 'chunked', 'sdpa'],
+                    help='how the encoder attention is computed, the results are the same '
+                         '(default: bmm, sdpa needs torch >= 2.1)')
 
 
 
@@ -105,35 +140,77 @@ def main():
         components.append("composition")
 
 
-    dataset = PDDDataNormalized(*args.data_options)
+    # Reuse the PDD scaling of the model being resumed instead of refitting it
+    pdd_scaler = None
+    if args.resume and os.path.isfile(args.resume):
+        checkpoint = torch.load(args.resume)
+        if checkpoint.get('pdd_scaler') is not None:
+            pdd_scaler = PDDScaler()
+            pdd_scaler.load_state_dict(checkpoint['pdd_scaler'])
 
-    collate_fn = collate_pool
-    train_loader, val_loader, test_loader = get_train_val_test_loader(
-        dataset=dataset,
-        collate_fn=collate_fn,
-        batch_size=args.batch_size,
-        train_ratio=args.train_ratio,
-        num_workers=args.workers,
-        val_ratio=args.val_ratio,
-        test_ratio=args.test_ratio,
-        pin_memory=args.cuda,
-        train_size=args.train_size,
-        val_size=args.val_size,
-        test_size=args.test_size,
-        return_test=True)
+    # a feature store is only reused if it was built with the same featurization and PDD scaling
+    reuse_store, store_meta = False, None
+    if args.feature_store and not args.stream:
+        store_meta = data_options_meta(*args.data_options)
+        if feature_store_exists(args.feature_store):
+            mismatch = feature_store_mismatch(args.feature_store, store_meta, pdd_scaler)
+            if mismatch is not None:
+                warnings.warn('Rebuilding feature store {}: {}'.format(args.feature_store, mismatch))
+            reuse_store = mismatch is None
+
+    collate_fn = collate_packed if args.packed else collate_pool
+    if args.stream:
+        feature_cache = FeatureCache(args.feature_cache) if args.feature_cache else None
+        train_loader, val_loader, test_loader, dataset = get_train_val_test_streams(
+            args.data_options,
+            collate_fn=collate_fn,
+            batch_size=args.batch_size,
+            train_ratio=args.train_ratio,
+            num_workers=args.workers,
+            val_ratio=args.val_ratio,
+            test_ratio=args.test_ratio,
+            pin_memory=args.cuda,
+            train_size=args.train_size,
+            val_size=args.val_size,
+            test_size=args.test_size,
+            pdd_scaler=pdd_scaler,
+            scaler_sample=args.scaler_sample or None,
+            feature_cache=feature_cache)
+    elif reuse_store:
+        dataset = PackedPDDData(args.feature_store, meta=store_meta, pdd_scaler=pdd_scaler)
+    else:
+        feature_cache = FeatureCache(args.feature_cache) if args.feature_cache else None
+        dataset = PDDDataNormalized(*args.data_options, workers=args.featurize_workers,
+                                    feature_cache=feature_cache, pdd_scaler=pdd_scaler)
+        if args.feature_store:
+            pack_dataset(dataset, args.feature_store)
+            dataset = PackedPDDData(args.feature_store, meta=store_meta)
+
+    if not args.stream:
+        train_loader, val_loader, test_loader = get_train_val_test_loader(
+            dataset=dataset,
+            collate_fn=collate_fn,
+            batch_size=args.batch_size,
+            train_ratio=args.train_ratio,
+            num_workers=args.workers,
+            val_ratio=args.val_ratio,
+            test_ratio=args.test_ratio,
+            pin_memory=args.cuda,
+            train_size=args.train_size,
+            val_size=args.val_size,
+            test_size=args.test_size,
+            bucket_size=args.bucket_size,
+            max_tokens=args.max_tokens or None,
+            resident=args.resident,
+            return_test=True)
 
     if len(dataset) < 500:
         warnings.warn('Dataset has less than 500 data points. '
                       'Lower accuracy is expected. ')
-        sample_data_list = [dataset[i] for i in range(len(dataset))]
-    else:
-        #sample_data_list = [dataset[i] for i in sample(range(len(dataset)), 500)]
-        sample_data_list = [dataset[i] for i in range(len(dataset))]
-    _, sample_target, _ = collate_pool(sample_data_list)
-    normalizer = Normalizer(sample_target)
+    normalizer = Normalizer.from_targets(dataset_targets(dataset))
 
-    # build model
-    orig_atom_fea_len = dataset[0][0].shape[-1]
+    # build model, a PDD has k + 1 columns (the weight and k distances)
+    orig_atom_fea_len = dataset.k + 1 if args.stream else dataset[0][0].shape[-1]
     # m=dataset[0]
     # m1=dataset[1]
     # m2=dataset[2]
@@ -145,7 +222,10 @@ def main():
                                    n_encoders=args.num_encoders,
                                    decoder_layers=args.num_decoder,
                                    components=components,
-                                   use_cuda=args.cuda)
+                                   use_cuda=args.cuda,
+                                   mask_padding=args.mask_padding,
+                                   attention=args.attention,
+                                   fuse_embedding=args.fuse_embedding)
 
     if args.cuda:
         model.cuda()
@@ -181,10 +261,13 @@ def main():
                             gamma=0.1)
     m = 0
     for epoch in range(args.start_epoch, args.epochs):
-        train(train_loader, model, criterion, optimizer, epoch, normalizer, cuda=args.cuda)
+        if args.stream:
+            dataset.set_epoch(epoch)
+        train(train_loader, model, criterion, optimizer, epoch, normalizer, cuda=args.cuda, prefetch=args.prefetch)
 
         pred_time_start = time.time()
-        mae_error = validate(val_loader, model, criterion, normalizer, cuda=args.cuda, csv_name='test_results.csv')
+        mae_error = validate(val_loader, model, criterion, normalizer, cuda=args.cuda, csv_name='test_results.csv',
+                             prefetch=args.prefetch)
         pred_time_end = time.time()
         prediction_time = pred_time_end - pred_time_start
 
@@ -203,6 +286,7 @@ def main():
             'best_mae_error': best_mae_error,
             'optimizer': optimizer.state_dict(),
             'normalizer': normalizer.state_dict(),
+            'pdd_scaler': dataset.pdd_scaler.state_dict() if dataset.pdd_scaler is not None else None,
             'args': vars(args)
         }, is_best)
 
@@ -1,16 +1,23 @@
+import multiprocessing
+import os
 import pickle
 import random
+import sys
 import time
+from concurrent.futures import ProcessPoolExecutor
 from random import sample
 
 random.seed(0)
 from matbench.bench import MatbenchBenchmark
 from model import PeriodicSetTransformer
-from data import PDDDataPymatgen, collate_pool, get_train_val_test_loader
+from data import PDDDataPymatgen, PDDDataSubset, _share_memory, collate_packed, collate_pool, dataset_targets, \
+    get_train_val_test_loader
+from featurize import FeatureCache
 import torch.nn as nn
 import torch.optim as optim
 import torch
 
+from torch.utils.data import Subset
 from torch.autograd import Variable
 from torch.optim.lr_scheduler import MultiStepLR
 from train import train, validate, save_checkpoint, Normalizer
@@ -30,34 +37,49 @@ def get_model(orig_atom_fea_len, hp, cuda=True):
                                    attention_dropout=hp["attention_dropout"],
                                    use_cuda=cuda,
                                    use_weighted_pooling=True,
-                                   use_weighted_attention=True)
+                                   use_weighted_attention=True,
+                                   mask_padding=hp.get("mask_padding", False),
+                                   attention=hp.get("attention", "bmm"),
+                                   fuse_embedding=hp.get("fuse_embedding", False))
     if cuda:
         model.cuda()
     return model
 
 
-def get_data(train_inputs, train_outputs, test_inputs, test_outputs, data_options):
-    dataset = PDDDataPymatgen(pd.concat([train_inputs, test_inputs]),
-                              pd.concat([train_outputs, test_outputs]),
+def get_data(task, data_options):
+    # Featurize every structure of the task once, the folds are views into this dataset
+    dataset = PDDDataPymatgen(task.df[task.metadata.input_type],
+                              task.df[task.metadata.target],
                               k=data_options["k"],
                               collapse_tol=data_options["tol"],
-                              collapse=True)
+                              collapse=True,
+                              feature_cache=FeatureCache(),
+                              use_asymmetric_unit=data_options.get("asymmetric_unit", False))
     return dataset
 
 
-def run_fold(fold, task, training_options, data_options, hp, use_cuda=True, suffix=""):
+def get_fold_data(dataset, train_outputs, test_outputs):
+    return PDDDataSubset(dataset, pd.concat([train_outputs, test_outputs]))
+
+
+def run_fold(fold, task, training_options, data_options, hp, use_cuda=True, suffix="", dataset=None):
     best_mae_error = 1e10
+    if dataset is None:
+        dataset = get_data(task, data_options)
     train_inputs, train_outputs = task.get_train_and_val_data(fold)
     test_inputs, test_outputs = task.get_test_data(fold, include_target=True)
     test_size = test_inputs.shape[0]
     val_size = int(len(train_outputs) * training_options["val_ratio"])
     train_size = len(train_outputs) - val_size
-    dataset = get_data(train_inputs, train_outputs, test_inputs, test_outputs * 0, data_options)
-    collate_fn = collate_pool
+    dataset = get_fold_data(dataset, train_outputs, test_outputs * 0)
+    collate_fn = collate_packed if training_options.get("packed") else collate_pool
     train_loader, val_loader, test_loader = get_train_val_test_loader(
         dataset=dataset,
         collate_fn=collate_fn,
         batch_size=training_options["batch_size"],
+        bucket_size=training_options.get("bucket_size"),
+        max_tokens=training_options.get("max_tokens"),
+        resident=training_options.get("resident", False),
         train_ratio=None,
         pin_memory=training_options["cuda"],
         train_size=train_size,
@@ -66,11 +88,7 @@ def run_fold(fold, task, training_options, data_options, hp, use_cuda=True, suff
         num_workers=0,
         return_test=True)
     orig_atom_fea_len = dataset[0][0].shape[-1]
-    # sample_size = min(train_outputs.shape[0], 5000)
-    # sample_data_list = [dataset[i] for i in sample(range(train_outputs.shape[0]), sample_size)]
-    sample_data_list = [dataset[i] for i in range(train_outputs.shape[0])]
-    _, sample_target, _ = collate_pool(sample_data_list)
-    normalizer = Normalizer(sample_target)
+    normalizer = Normalizer.from_targets(dataset_targets(Subset(dataset, range(train_outputs.shape[0]))))
     model = get_model(orig_atom_fea_len, hp, cuda=use_cuda)
     criterion = nn.L1Loss()
     optimizer = optim.Adam(model.parameters(), training_options["lr"],
@@ -79,7 +97,8 @@ def run_fold(fold, task, training_options, data_options, hp, use_cuda=True, suff
                             gamma=0.1)
     start_time = time.time()
     for epoch in range(training_options["epochs"]):
-        train(train_loader, model, criterion, optimizer, epoch, normalizer, cuda=use_cuda, print_epoch=epoch % 50 == 0)
+        train(train_loader, model, criterion, optimizer, epoch, normalizer, cuda=use_cuda, print_epoch=epoch % 50 == 0,
+              prefetch=training_options.get("prefetch", False))
         # mae_error = validate(val_loader, model, criterion, normalizer)
         # if mae_error != mae_error:
         #    print('Exit due to NaN')
@@ -102,7 +121,59 @@ def run_fold(fold, task, training_options, data_options, hp, use_cuda=True, suff
     return predictions
 
 
-def main(verbose=True, suffix=""):
+# task name -> (task, dataset), filled before the fold pool is forked so workers inherit it
+_FOLD_DATA = {}
+
+
+def _init_fold_data(fold_data):
+    _FOLD_DATA.update(fold_data)
+
+
+def _run_fold_job(job):
+    task_name, fold, suffix, threads = job
+    task, dataset = _FOLD_DATA[task_name]
+    pset = p[task_name]
+    torch.set_num_threads(threads)
+    # Seed every fold, so its result does not depend on which folds ran before it in the same process
+    torch.manual_seed(0)
+    torch.cuda.manual_seed_all(3)
+    st = time.time()
+    predictions = run_fold(fold, task, pset["training_options"], pset["data_options"], pset["hp"],
+                           use_cuda=torch.cuda.is_available(), suffix=suffix, dataset=dataset)
+    return task_name, fold, predictions, time.time() - st
+
+
+def _run_folds(jobs, workers):
+    """
+    Runs (task name, fold) jobs in a pool of at most workers processes, splitting the cores
+    evenly between them with torch.set_num_threads. Results are yielded in job order.
+    """
+    workers = max(1, min(workers, len(jobs)))
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    jobs = [(task_name, fold, suffix, threads) for task_name, fold, suffix in jobs]
+    if workers == 1:
+        for job in jobs:
+            yield _run_fold_job(job)
+        return
+    if "fork" in multiprocessing.get_all_start_methods():
+        # fork so the featurized datasets are shared with the workers instead of pickled per job
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"))
+    else:
+        # e.g. Windows: every worker receives the datasets once, their tensors in shared memory
+        for _, dataset in _FOLD_DATA.values():
+            _share_memory(dataset)
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_fold_data,
+                                       initargs=(dict(_FOLD_DATA),))
+    with executor:
+        yield from executor.map(_run_fold_job, jobs)
+
+
+def main(verbose=True, suffix="", workers=1):
+    """
+    workers > 1 trains folds concurrently (CPU only, folds of consecutive small tasks are
+    scheduled together so that at least workers folds run at once). workers=None uses one
+    worker per fold scheduled, up to the number of cores.
+    """
     mb = MatbenchBenchmark(autoload=False)
 
     tasks = [
@@ -115,39 +186,48 @@ def main(verbose=True, suffix=""):
         mb.matbench_mp_e_form,
         mb.matbench_mp_gap
     ]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if torch.cuda.is_available():
+        workers = 1
 
+    waves = [[]]
     for task in tasks:
-        torch.manual_seed(0)
-        torch.cuda.manual_seed_all(3)
-        
-        pset = p[task.dataset_name]
-        training_options = pset["training_options"]
-        hp = pset["hp"]
-        data_options = pset["data_options"]
-        task.load()
-        fold_times = []
-        for fold in task.folds:
-            st = time.time()
-            predictions = run_fold(fold, task, training_options, data_options, hp, use_cuda=torch.cuda.is_available(), suffix=suffix)
-            end = time.time()
+        waves[-1].append(task)
+        if sum(len(t.folds) for t in waves[-1]) >= workers:
+            waves.append([])
+
+    for wave in waves:
+        if not wave:
+            continue
+        _FOLD_DATA.clear()
+        for task in wave:
+            task.load()
+            _FOLD_DATA[task.dataset_name] = (task, get_data(task, p[task.dataset_name]["data_options"]))
+        jobs = [(task.dataset_name, fold, suffix) for task in wave for fold in task.folds]
+        fold_times = {task.dataset_name: [] for task in wave}
+        for task_name, fold, predictions, seconds in _run_folds(jobs, workers):
+            task = _FOLD_DATA[task_name][0]
             if verbose:
-                print(f"Fold took {end-st} seconds")
-                fold_times.append(end-st)
-            
-            with open(f"{task.dataset_name}_fold{fold}_predictions_{suffix}", "wb") as f:
+                print(f"{task_name} fold {fold} took {seconds} seconds")
+                fold_times[task_name].append(seconds)
+
+            with open(f"{task_name}_fold{fold}_predictions_{suffix}", "wb") as f:
                 pickle.dump(predictions, f)
-            
+
             task.record(fold, predictions)
-        
-        if verbose:
-            print(task.scores)
-        
-        with open(f"{task.dataset_name}_mat2vec_v2_results_{suffix}.txt", "w") as f:
-            f.write(str(task.scores))
-            f.write("\n")
-            f.write(str(fold_times))
-            f.write("\n")
-            f.write(str(np.mean(fold_times)))
+
+        for task in wave:
+            if verbose:
+                print(task.scores)
+
+            with open(f"{task.dataset_name}_mat2vec_v2_results_{suffix}.txt", "w") as f:
+                f.write(str(task.scores))
+                f.write("\n")
+                f.write(str(fold_times[task.dataset_name]))
+                f.write("\n")
+                f.write(str(np.mean(fold_times[task.dataset_name])))
+    _FOLD_DATA.clear()
 
     my_metadata = {
         "PeST": "v0.2",
@@ -157,6 +237,5 @@ def main(verbose=True, suffix=""):
     mb.to_file(f"results_v2_{'_'.join(t.dataset_name for t in tasks)}_{suffix}.json.gz")
 
 
-
 if __name__ == "__main__":
-    main()
+    main(workers=int(sys.argv[1]) if len(sys.argv) > 1 else 1)
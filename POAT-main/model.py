@@ -54,23 +54,44 @@ def expand_mask(mask):
 
 ###
 class Point_Transformer_Last(nn.Module):
-    def __init__(self,embedding_dim):
+    def __init__(self,embedding_dim, attention="bmm"):
         super(Point_Transformer_Last, self).__init__()
         self.embedding_dim = embedding_dim
-        self.sa1 = SA_Layer(embedding_dim)
-        self.sa2 = SA_Layer(embedding_dim)
-        self.sa3 = SA_Layer(embedding_dim)
-        self.sa4 = SA_Layer(embedding_dim)
+        self.sa1 = SA_Layer(embedding_dim, attention=attention)
+        self.sa2 = SA_Layer(embedding_dim, attention=attention)
+        self.sa3 = SA_Layer(embedding_dim, attention=attention)
+        self.sa4 = SA_Layer(embedding_dim, attention=attention)
 
-    def forward(self, x):
+    def forward(self, x, mask=None, cu_seqlens=None):
             # B, D, N
-        x1 = self.sa1(x)
-        x2 = self.sa2(x1)
+        x1 = self.sa1(x, mask, cu_seqlens)
+        x2 = self.sa2(x1, mask, cu_seqlens)
         x = torch.cat((x1, x2), dim=1)
         return x
+# F.scaled_dot_product_attention exists from torch 2.0, its scale argument from 2.1
+_SDPA_WITH_SCALE = tuple(int(v) for v in torch.__version__.split("+")[0].split(".")[:2]) >= (2, 1)
+
+
 class SA_Layer(nn.Module):
-    def __init__(self, embedding_dim):
+    """
+    Offset attention: a row softmax of the energy followed by a column normalisation. attention
+    selects how it is computed, all three give the same result:
+    "bmm" materialises the b x n x n attention matrix (the original implementation),
+    "chunked" builds it chunk_size rows at a time and accumulates the output and column sums,
+    "sdpa" computes the row log-sum-exp in chunks and runs the column normalised attention as a
+    fused F.scaled_dot_product_attention with keys and queries swapped (the 1e-9 of the column
+    normalisation is dropped, so results agree to float precision).
+    """
+
+    def __init__(self, embedding_dim, attention="bmm", chunk_size=128):
         super(SA_Layer, self).__init__()
+        if attention not in ["bmm", "chunked", "sdpa"]:
+            raise ValueError(f"attention must be in {['bmm', 'chunked', 'sdpa']}")
+        if attention == "sdpa" and not _SDPA_WITH_SCALE:
+            raise ValueError(f"attention='sdpa' needs F.scaled_dot_product_attention with scale= (torch >= 2.1), "
+                             f"torch {torch.__version__} is installed; use 'chunked' instead")
+        self.attention = attention
+        self.chunk_size = chunk_size
         self.q_conv = nn.Conv1d(embedding_dim, embedding_dim // 2, 1, bias=False)
         self.k_conv = nn.Conv1d(embedding_dim, embedding_dim // 2, 1, bias=False)
         # self.q_conv.conv.weight = self.k_conv.conv.weight
@@ -80,17 +101,72 @@ class SA_Layer(nn.Module):
         self.act = nn.ReLU()
         self.softmax = nn.Softmax(dim=-1)
 
-    def forward(self, x):
+    def forward(self, x, mask=None, cu_seqlens=None):
+        # mask: b, n, True for real (not padded) points
+        # cu_seqlens: boundaries of the structures in a packed 1, c, n batch, attention stays within each
         x_q = self.q_conv(x).permute(0, 2, 1)  # b, n, c
         x_k = self.k_conv(x)  # b, c, n
         x_v = self.v_conv(x)
+        if cu_seqlens is not None:
+            x_r = torch.cat([self._offset_attention(x_q[:, start:end], x_k[:, :, start:end], x_v[:, :, start:end])
+                             for start, end in zip(cu_seqlens[:-1], cu_seqlens[1:])], dim=2)
+        else:
+            x_r = self._offset_attention(x_q, x_k, x_v, mask)
+        if mask is None:
+            x_r = self.act(self.after_norm(self.trans_conv(x - x_r)))
+            return x + x_r
+        # Only the real points go through trans_conv and the batch norm statistics, padding is left as is
+        x_t = x.permute(0, 2, 1)
+        x_r = (x_t - x_r.permute(0, 2, 1))[mask]  # m, c
+        x_r = F.linear(x_r, self.trans_conv.weight.squeeze(-1), self.trans_conv.bias)
+        x_r = self.act(self.after_norm(x_r))
+        out = x_t.clone()
+        out[mask] = x_t[mask] + x_r
+        return out.permute(0, 2, 1)
+
+    def _offset_attention(self, x_q, x_k, x_v, mask=None):
+        if self.attention == "chunked":
+            return self._chunked_attention(x_q, x_k, x_v, mask)
+        if self.attention == "sdpa":
+            return self._sdpa_attention(x_q, x_k, x_v, mask)
         energy = torch.bmm(x_q, x_k)  # b, n, n
+        if mask is not None:
+            energy = energy.masked_fill(~mask[:, None, :], float("-inf"))
         attention = self.softmax(energy)
+        if mask is not None:
+            attention = attention * mask[:, :, None]
         attention = attention / (1e-9 + attention.sum(dim=1, keepdims=True))
-        x_r = torch.bmm(x_v, attention)  # b, c, n
-        x_r = self.act(self.after_norm(self.trans_conv(x - x_r)))
-        x = x + x_r
-        return x
+        return torch.bmm(x_v, attention)  # b, c, n
+
+    def _row_chunks(self, x_q, x_k, mask):
+        # Row softmax of the energy, chunk_size query rows at a time
+        for start in range(0, x_q.shape[1], self.chunk_size):
+            end = start + self.chunk_size
+            energy = torch.bmm(x_q[:, start:end], x_k)  # b, chunk, n
+            if mask is not None:
+                energy = energy.masked_fill(~mask[:, None, :], float("-inf"))
+            yield start, end, energy
+
+    def _chunked_attention(self, x_q, x_k, x_v, mask):
+        x_r = 0
+        column_sum = 0
+        for start, end, energy in self._row_chunks(x_q, x_k, mask):
+            attention = self.softmax(energy)
+            if mask is not None:
+                attention = attention * mask[:, start:end, None]
+            x_r = x_r + torch.bmm(x_v[:, :, start:end], attention)  # b, c, n
+            column_sum = column_sum + attention.sum(dim=1, keepdims=True)
+        return x_r / (1e-9 + column_sum)
+
+    def _sdpa_attention(self, x_q, x_k, x_v, mask):
+        # attention[i, j] / sum_i attention[i, j] is a softmax over i of energy[i, j] - logsumexp_j energy[i, j]
+        lse = torch.cat([torch.logsumexp(energy, dim=-1) for _, _, energy in self._row_chunks(x_q, x_k, mask)], dim=1)
+        bias = -lse
+        if mask is not None:
+            bias = bias.masked_fill(~mask, float("-inf"))
+        x_r = F.scaled_dot_product_attention(x_k.permute(0, 2, 1), x_q, x_v.permute(0, 2, 1),
+                                             attn_mask=bias[:, None, :], scale=1.0)  # b, n, c
+        return x_r.permute(0, 2, 1)
 
 ###自定义函数结束
 
@@ -101,10 +177,13 @@ class VectorAttention(nn.Module):
         embed_channels,
         attention_dropout=0.0,
         qkv_bias=True,
-        activation=nn.ReLU
+        activation=nn.ReLU,
+        chunk_size=None
     ):
         super(VectorAttention, self).__init__()
         self.embed_channels = embed_channels
+        # Process chunk_size query rows at a time so only b x chunk_size x n x c is held, None for all at once
+        self.chunk_size = chunk_size
         self.attn_drop_rate = attention_dropout
         self.qkv_bias = qkv_bias
 
@@ -136,11 +215,19 @@ class VectorAttention(nn.Module):
             self.linear_k(feat),
             self.linear_v(feat),
         )
+        if self.chunk_size is None:
+            return self._attend(query, key, value, distribution, distribution)
+        # The softmax is over keys, so every block of query rows is independent of the others
+        return torch.cat([self._attend(query[:, start:start + self.chunk_size], key, value,
+                                       distribution[:, start:start + self.chunk_size], distribution)
+                          for start in range(0, query.shape[1], self.chunk_size)], dim=1)
+
+    def _attend(self, query, key, value, query_distribution, distribution):
         relation_qk = key.unsqueeze(-3) - query.unsqueeze(-2)
         weight = self.weight_encoding(relation_qk)
         weight = self.attn_drop(weighted_softmax(weight, dim=-2, weights=distribution.unsqueeze(1)))
 
-        mask = (distribution * distribution.transpose(-1, -2)) > 0
+        mask = (query_distribution * distribution.transpose(-1, -2)) > 0
         weight = weight * mask.unsqueeze(-1)
         feat = torch.einsum("b i j k, b j k -> b i k", weight, value)
         return feat
@@ -148,7 +235,8 @@ class VectorAttention(nn.Module):
 
 
 class PeriodicSetTransformerEncoder(nn.Module):
-    def __init__(self, embedding_dim, num_heads, attention_dropout=0.0, dropout=0.0, activation=nn.Mish, use_va=False):
+    def __init__(self, embedding_dim, num_heads, attention_dropout=0.0, dropout=0.0, activation=nn.Mish, use_va=False,
+                 attention="bmm", va_chunk_size=None):
         super(PeriodicSetTransformerEncoder, self).__init__()
         if use_va:
             self.embedding = nn.Linear(embedding_dim, embedding_dim)
@@ -162,23 +250,31 @@ class PeriodicSetTransformerEncoder(nn.Module):
         # self.multihead_attention = MHA(embedding_dim, embedding_dim * num_heads, num_heads, dropout=attention_dropout)
         self.vector_attention = VectorAttention(embedding_dim,
                                                 attention_dropout=attention_dropout,
-                                                activation=activation)
+                                                activation=activation,
+                                                chunk_size=va_chunk_size)
         self.pre_norm = nn.LayerNorm(embedding_dim)
         self.ln = torch.nn.LayerNorm(embedding_dim)
         self.ffn = nn.Linear(embedding_dim, embedding_dim)
         self.ffn = nn.Sequential(nn.Linear(embedding_dim, embedding_dim),
                                  activation())
 
-        self.pt_last = Point_Transformer_Last(embedding_dim)
+        self.pt_last = Point_Transformer_Last(embedding_dim, attention=attention)
 
-    def forward(self, x, weights, use_weights=True):
+    def forward(self, x, weights, use_weights=True, mask=None, cu_seqlens=None):
+        # mask: b, n, True for real rows, excludes the padding from attention (pt_last only)
+        # cu_seqlens: structure boundaries when x is a packed 1, n, c batch
         x_norm = self.ln(x)
         x_norm=x_norm.permute(0, 2, 1)    ####
-        if self.use_va:
-            att_output = self.vector_attention(x_norm, weights)
+        if self.use_va and cu_seqlens is not None:
+            att_output = torch.cat([self.vector_attention(x_norm[:, :, start:end].permute(0, 2, 1),
+                                                          weights[:, start:end])
+                                    for start, end in zip(cu_seqlens[:-1], cu_seqlens[1:])], dim=1).permute(0, 2, 1)
+        elif self.use_va:
+            # VectorAttention works on b, n, c
+            att_output = self.vector_attention(x_norm.permute(0, 2, 1), weights).permute(0, 2, 1)
         else:
             # att_output = self.multihead_attention(x_norm, weights)
-            att_output = self.pt_last(x_norm)
+            att_output = self.pt_last(x_norm, mask, cu_seqlens)
         att_output=att_output.permute(0, 2, 1)
         output1 = x + self.out(att_output)
         output2 = self.ln(output1)
@@ -191,7 +287,7 @@ class PeriodicSetTransformer(nn.Module):
     def __init__(self, str_fea_len, embed_dim, num_heads, n_encoders=3, decoder_layers=1, components=None,
                  expansion_size=10, dropout=0., attention_dropout=0., use_cuda=True, atom_encoding="mat2vec",
                  use_weighted_attention=True, use_weighted_pooling=True, activation=nn.Mish, sigmoid_out=False,
-                 expand_distances=True):
+                 expand_distances=True, mask_padding=False, attention="bmm", fuse_embedding=False):
         super(PeriodicSetTransformer, self).__init__()
         if components is None:
             components = ["pdd", "composition"]
@@ -207,6 +303,11 @@ class PeriodicSetTransformer(nn.Module):
         self.use_weighted_attention = use_weighted_attention
         self.use_weighted_pooling = use_weighted_pooling
         self.expand_distances = expand_distances
+        # Exclude the rows added by collate_pool (zero weight) from attention and batch norm
+        self.mask_padding = mask_padding
+        # Outside training look up comp_embedding_layer(atom_fea) rows instead of projecting every atom
+        self.fuse_embedding = fuse_embedding
+        self._comp_table = None
         if self.expand_distances:
             self.pdd_embedding_layer = nn.Linear((str_fea_len - 1) * expansion_size, embed_dim)
         else:
@@ -221,7 +322,8 @@ class PeriodicSetTransformer(nn.Module):
         self.cell_embed = nn.Linear(6, 32)
         self.softplus = nn.Softplus()
         self.encoders = nn.ModuleList(
-            [PeriodicSetTransformerEncoder(embed_dim, num_heads, attention_dropout=attention_dropout, activation=activation) for _ in
+            [PeriodicSetTransformerEncoder(embed_dim, num_heads, attention_dropout=attention_dropout, activation=activation,
+                                           attention=attention) for _ in
              range(n_encoders)])
         self.decoder = nn.ModuleList([nn.Linear(embed_dim, embed_dim)
                                       for _ in range(decoder_layers - 1)])
@@ -232,11 +334,24 @@ class PeriodicSetTransformer(nn.Module):
         self.sigmoid = nn.Sigmoid()
 
     def forward(self, features):
-        str_fea, comp_fea, cell_fea = features
+        # collate_pool gives padded (str_fea, comp_fea, cell_fea). collate_packed concatenates the rows of
+        # all structures and adds cu_seqlens and batch_index, the batch then runs as one 1, n, c sequence
+        # with attention within each structure and segment sums for pooling, which matches mask_padding.
+        packed = len(features) == 5
+        if packed:
+            str_fea, comp_fea, cell_fea, cu_seqlens, batch_index = features
+            str_fea, comp_fea = str_fea[None], comp_fea[None]
+            segments = cu_seqlens.tolist()
+        else:
+            str_fea, comp_fea, cell_fea = features
+            segments = None
         weights = str_fea[:, :, 0, None]
-        comp_features = self.af(comp_fea)
-        comp_features = self.comp_embedding_layer(comp_features)
-        comp_features = self.dropout_layer(comp_features)
+        if self.fuse_embedding and not self.training:
+            comp_features = self.comp_table()[comp_fea.long()].squeeze(-2)
+        else:
+            comp_features = self.af(comp_fea)
+            comp_features = self.comp_embedding_layer(comp_features)
+            comp_features = self.dropout_layer(comp_features)
         str_features = str_fea[:, :, 1:]
 
         if self.expand_distances:
@@ -250,10 +365,16 @@ class PeriodicSetTransformer(nn.Module):
         elif self.pdd_encoding:
             x = str_features
         x_init = x
+        mask = weights[:, :, 0] > 0 if self.mask_padding and not packed else None
         for encoder in self.encoders:
-            x = encoder(x, weights, use_weights=self.use_weighted_attention)
-
-        if self.use_weighted_pooling:
+            x = encoder(x, weights, use_weights=self.use_weighted_attention, mask=mask, cu_seqlens=segments)
+
+        if packed:
+            x = (weights * (x + x_init) if self.use_weighted_pooling else x + x_init)[0]
+            x = x.new_zeros((len(segments) - 1, x.shape[-1])).index_add_(0, batch_index, x)
+            if not self.use_weighted_pooling:
+                x = x / torch.diff(cu_seqlens)[:, None]
+        elif self.use_weighted_pooling:
             x = torch.sum(weights * (x + x_init), dim=1)
         else:
             x = torch.mean(x + x_init, dim=1)
@@ -267,6 +388,31 @@ class PeriodicSetTransformer(nn.Module):
             return self.sigmoid(self.out(x))
         return self.out(x)
 
+    def comp_table(self):
+        """
+        comp_embedding_layer applied to every row of the atom feature table, built on the first
+        lookup. It is dropped whenever the parameters may change (train()/eval(), load_state_dict,
+        .cuda()/.to()), so it is rebuilt after training; call train() again after editing the
+        parameters in place while in eval mode.
+        """
+        if self._comp_table is None:
+            with torch.no_grad():
+                self._comp_table = self.comp_embedding_layer(
+                    self.af.atom_fea.to(self.comp_embedding_layer.weight.device))
+        return self._comp_table
+
+    def train(self, mode=True):
+        self._comp_table = None
+        return super(PeriodicSetTransformer, self).train(mode)
+
+    def load_state_dict(self, state_dict, strict=True):
+        self._comp_table = None
+        return super(PeriodicSetTransformer, self).load_state_dict(state_dict, strict=strict)
+
+    def _apply(self, fn, *args, **kwargs):
+        self._comp_table = None
+        return super(PeriodicSetTransformer, self)._apply(fn, *args, **kwargs)
+
 
 class PeSTEncoder(nn.Module):
 
@@ -316,7 +462,7 @@ class AtomFeaturizer(nn.Module):
             self.atom_fea = torch.Tensor(af)
 
     def forward(self, x):
-        return torch.squeeze(self.atom_fea[x.long()])
+        return self.atom_fea[x.long()].squeeze(-2)
 
 
 class DistanceExpansion(nn.Module):
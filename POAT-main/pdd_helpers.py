@@ -1,31 +1,143 @@
 import AMD
-import collections
-from scipy.spatial.distance import squareform, pdist
+from scipy.spatial.distance import pdist
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
 import numpy as np
 from itertools import permutations, combinations
 
 
+def _condensed_to_pairs(condensed_inds, n):
+    # Row/column of entries in a scipy condensed distance vector, without forming the square matrix
+    c = condensed_inds.astype(np.float64)
+    i = (n - 2 - np.floor(np.sqrt(-8 * c + 4 * n * (n - 1) - 7) / 2 - 0.5)).astype(np.int64)
+    j = (condensed_inds + i + 1 - n * (n - 1) // 2 + (n - i) * (n - i - 1) // 2).astype(np.int64)
+    return i, j
+
+
 def _collapse_into_groups(overlapping):
-    overlapping = squareform(overlapping)
-    group_nums = {}  # row_ind: group number
-    group = 0
-    for i, row in enumerate(overlapping):
-        if i not in group_nums:
-            group_nums[i] = group
-            group += 1
-
-            for j in np.argwhere(row).T[0]:
-                if j not in group_nums:
-                    group_nums[j] = group_nums[i]
-
-    groups = collections.defaultdict(list)
-    for row_ind, group_num in sorted(group_nums.items()):
-        groups[group_num].append(row_ind)
-    groups = list(groups.values())
+    n = int(round((1 + np.sqrt(1 + 8 * len(overlapping))) / 2))
+    i, j = _condensed_to_pairs(np.flatnonzero(overlapping), n)
+    return _group_pairs(i, j, n)
+
+
+def _overlapping_pairs(dists, collapse_tol, labels=None):
+    # Pairs of rows (i < j) with the same label within Chebyshev distance collapse_tol of each other
+    if labels is None:
+        buckets = [np.arange(len(dists))]
+    else:
+        order = np.argsort(labels, kind="stable")
+        buckets = np.split(order, np.flatnonzero(np.diff(labels[order])) + 1)
+    i, j = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+    for rows in buckets:
+        if len(rows) < 2:
+            continue
+        pairs = cKDTree(dists[rows]).query_pairs(collapse_tol, p=np.inf, output_type="ndarray")
+        i.append(rows[pairs[:, 0]])
+        j.append(rows[pairs[:, 1]])
+    return np.concatenate(i), np.concatenate(j)
+
+
+# Below this many rows a plain walk over the pairs is cheaper than building the sparse graph
+_SMALL_GROUPING_ROWS = 128
+# collapse_method="auto" uses the KD-tree collapse above this many rows, below it pdist is faster
+_KDTREE_COLLAPSE_ROWS = 300
+
+
+def _group_pairs_small(i, j, n):
+    # A row joins the group of the first earlier row it overlaps with (pairs have i < j)
+    overlaps = [[] for _ in range(n)]
+    for row, col in zip(i.tolist(), j.tolist()):
+        overlaps[row].append(col)
+    group_nums = [-1] * n
+    groups = []
+    for row in range(n):
+        if group_nums[row] < 0:
+            group_nums[row] = len(groups)
+            groups.append([row])
+            for col in overlaps[row]:
+                if group_nums[col] < 0:
+                    group_nums[col] = group_nums[row]
+                    groups[-1].append(col)
+    return [sorted(group) for group in groups]
+
+
+def _group_pairs(i, j, n):
+    if n <= _SMALL_GROUPING_ROWS:
+        return _group_pairs_small(i, j, n)
+    graph = csr_matrix((np.ones(len(i), dtype=np.int8), (i, j)), shape=(n, n))
+    n_components, labels = connected_components(graph, directed=False)
+
+    # A row joins the group of the first earlier row it overlaps with. When a component
+    # is fully connected that is the component itself, otherwise assign its rows greedily.
+    sizes = np.bincount(labels, minlength=n_components)
+    n_edges = np.bincount(labels[i], minlength=n_components)
+    order = np.argsort(labels, kind="stable")
+    members = np.split(order, np.cumsum(sizes)[:-1])
+    groups = []
+    adjacency = None
+    for component in np.flatnonzero(n_edges == sizes * (sizes - 1) // 2):
+        groups.append(members[component].tolist())
+    for component in np.flatnonzero(n_edges != sizes * (sizes - 1) // 2):
+        if adjacency is None:
+            adjacency = (graph + graph.T).tocsr()
+        assigned = set()
+        for row in members[component]:
+            if row in assigned:
+                continue
+            neighbours = adjacency.indices[adjacency.indptr[row]:adjacency.indptr[row + 1]]
+            group = [row] + [col for col in neighbours if col not in assigned]
+            assigned.update(group)
+            groups.append(sorted(int(r) for r in group))
+    groups.sort(key=lambda group: group[0])
 
     return groups
 
 
+def _asymmetric_rows(periodic_set, motif, collapse_tol, constrained, dists, inds):
+    """
+    Rows left after merging every symmetry orbit into one row weighted by its multiplicity, or
+    None when no orbit can be merged. The orbits are the asymmetric unit and Wyckoff
+    multiplicities of the periodic set (as read by AMD.CifReader, whose motif lists every orbit
+    as a contiguous block), so no symmetry search is run. An orbit is only merged when the rows
+    of all its sites agree with the first one within collapse_tol and, if constrained, have the
+    same neighbour types, i.e. when the full collapse would merge them too.
+    """
+    asym_unit, multiplicities = periodic_set.asymmetric_unit, periodic_set.wyckoff_multiplicities
+    if asym_unit is None or multiplicities is None or len(asym_unit) == len(motif):
+        return None
+    asym_unit, multiplicities = np.asarray(asym_unit), np.asarray(multiplicities)
+    starts = np.concatenate([[0], np.cumsum(multiplicities)[:-1]])
+    if np.sum(multiplicities) != len(motif) or not np.array_equal(asym_unit, starts):
+        return None
+    first = np.repeat(asym_unit, multiplicities)
+    agree = np.max(np.abs(dists - dists[first]), axis=1) <= collapse_tol
+    if constrained:
+        neighbour_types = periodic_set.types[inds % len(motif)]
+        agree &= np.all(neighbour_types == neighbour_types[first], axis=1)
+    merged = np.logical_and.reduceat(agree, asym_unit) & (multiplicities > 1)
+    if not merged.any():
+        return None
+    keep = ~np.repeat(merged, multiplicities) | (np.arange(len(motif)) == first)
+    weights = np.where(np.repeat(merged, multiplicities), np.repeat(multiplicities, multiplicities), 1) / len(motif)
+    return np.flatnonzero(keep), weights[keep], dists[keep], inds[keep]
+
+
+def neighbour_query(periodic_set, k, use_asymmetric_unit=False, collapse_tol=1e-4, constrained=True):
+    motif, cell, _, _ = extract_motif_cell(periodic_set)
+    row_inds = np.arange(len(motif))
+    weights = np.full((len(motif),), 1 / len(motif))
+    dists, cloud, inds = AMD.nearest_neighbours(motif, cell, motif, k)
+    if use_asymmetric_unit and collapse_tol >= 0 and isinstance(periodic_set, AMD.PeriodicSet):
+        # Symmetry-equivalent sites have the same neighbours, so keep one row per orbit weighted
+        # by the orbit size and skip collapsing them. Rows keep the motif order of the full collapsed
+        # PDD. All sites are still queried: AMD's cloud and tree build dominate the query either way.
+        rows = _asymmetric_rows(periodic_set, motif, collapse_tol, constrained, dists, inds)
+        if rows is not None:
+            row_inds, weights, dists, inds = rows
+    return row_inds, weights, dists, cloud, inds
+
+
 def custom_PDD(
         periodic_set,
         k: int,
@@ -35,18 +147,42 @@ def custom_PDD(
         return_row_groups: bool = True,
         constrained: bool = True,
         return_angles: bool = False,
+        collapse_method: str = "pdist",
+        use_asymmetric_unit: bool = False,
+        neighbours=None,
 ) -> [np.ndarray]:
-    motif, cell, asymmetric_unit, weights = extract_motif_cell(periodic_set)
-    weights = np.full((len(motif),), 1 / len(motif))
-    dists, cloud, inds = AMD.nearest_neighbours(motif, cell, motif, k)
+    # neighbours can be the result of neighbour_query at any k' >= k, it is sliced down to k
+    if neighbours is None:
+        neighbours = neighbour_query(periodic_set, k, use_asymmetric_unit=use_asymmetric_unit and collapse,
+                                     collapse_tol=collapse_tol, constrained=constrained)
+    row_inds, weights, dists, cloud, inds = neighbours
+    dists, inds = dists[:, :k], inds[:, :k]
+    motif = periodic_set.motif if isinstance(periodic_set, AMD.PeriodicSet) else periodic_set[0]
+    row_types = periodic_set.types[row_inds]
     groups = [[i] for i in range(len(dists))]
     if return_angles:
-        angles = get_angles(motif, cloud, inds)
+        angles = get_angles(motif[row_inds], cloud, inds)
+
+    if collapse_method == "auto":
+        collapse_method = "kdtree" if len(dists) > _KDTREE_COLLAPSE_ROWS else "pdist"
+    if collapse and collapse_tol >= 0 and collapse_method == "kdtree":
+        # Only rows with the same atom type and neighbour types can merge, so search each bucket separately
+        labels = None
+        if constrained:
+            signatures = np.hstack((row_types[:, None], periodic_set.types[inds % periodic_set.types.shape[0]]))
+            labels = np.unique(signatures, axis=0, return_inverse=True)[1].reshape(-1)
+        i, j = _overlapping_pairs(dists, collapse_tol, labels)
+        if len(i):
+            groups = _group_pairs(i, j, len(dists))
+            weights = np.array([sum(weights[group]) for group in groups])
+            dists = np.array([np.average(dists[group], axis=0) for group in groups])
+            if return_angles:
+                angles = np.array([np.average(angles[group], axis=0) for group in groups])
 
-    if collapse and collapse_tol >= 0:
+    elif collapse and collapse_tol >= 0:
         overlapping = pdist(dists, metric='chebyshev')
         overlapping = overlapping <= collapse_tol
-        types_match = pdist(periodic_set.types.reshape((-1, 1))) == 0
+        types_match = pdist(row_types.reshape((-1, 1))) == 0
         neighbors_match = (pdist(periodic_set.types[inds % periodic_set.types.shape[0]]) == 0)
 
         if constrained:
@@ -64,6 +200,8 @@ def custom_PDD(
                 angles = np.array([np.average(angles[group], axis=0) for group in groups])
 
     pdd = np.hstack((weights[:, None], dists))
+    if len(row_inds) < len(motif):
+        groups = [[int(row_inds[i]) for i in group] for group in groups]
 
     if lexsort:
         lex_ordering = np.lexsort(np.rot90(dists))
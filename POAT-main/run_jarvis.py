@@ -1,11 +1,13 @@
 import os.path
 
 from model import PeriodicSetTransformer
-from data import JarvisData, collate_pool, get_train_val_test_loader
+from data import JarvisData, JarvisFeatures, collate_packed, collate_pool, dataset_targets, get_train_val_test_loader
+from featurize import FeatureCache
 import torch.nn as nn
 import torch.optim as optim
 import torch
 
+from torch.utils.data import Subset
 from torch.autograd import Variable
 from torch.optim.lr_scheduler import MultiStepLR
 from train import *
@@ -51,7 +53,10 @@ def get_model(orig_atom_fea_len, hp, cuda=True):
                                    components=["composition", "pdd"],
                                    attention_dropout=hp["attention_dropout"],
                                    use_cuda=cuda,
-                                   atom_encoding="mat2vec")
+                                   atom_encoding="mat2vec",
+                                   mask_padding=hp.get("mask_padding", False),
+                                   attention=hp.get("attention", "bmm"),
+                                   fuse_embedding=hp.get("fuse_embedding", False))
     if cuda:
         model.cuda()
     return model
@@ -76,6 +81,9 @@ def main(verbose=True):
         "optb88vdw_total_energy",
         "formation_energy_peratom",
     ]
+    # Featurize the union of the structures once, every property is a view into the same features
+    features = JarvisFeatures(props_to_run, k=param_set["data_options"]["k"],
+                              collapse_tol=param_set["data_options"]["tol"], feature_cache=FeatureCache())
     for prop_name in props_to_run:
         best_mae_error = 1e10
         print(f"Running property: {prop_name}")
@@ -83,16 +91,18 @@ def main(verbose=True):
         torch.cuda.manual_seed_all(3)
         training_options = param_set["training_options"]
         hp = param_set["hp"]
-        data_options = param_set["data_options"]
-        dataset = JarvisData(prop_name, k=data_options["k"], collapse_tol=data_options["tol"])
+        dataset = JarvisData(prop_name, features=features)
         val_ratio = 0.0
         test_ratio = 0.1
         train_ratio = 1 - val_ratio - test_ratio
-        collate_fn = collate_pool
+        collate_fn = collate_packed if training_options.get("packed") else collate_pool
         train_loader, val_loader, test_loader = get_train_val_test_loader(
             dataset=dataset,
             collate_fn=collate_fn,
             batch_size=training_options["batch_size"],
+            bucket_size=training_options.get("bucket_size"),
+            max_tokens=training_options.get("max_tokens"),
+            resident=training_options.get("resident", False),
             train_ratio=None,
             pin_memory=training_options["cuda"],
             val_ratio=val_ratio,
@@ -104,10 +114,8 @@ def main(verbose=True):
             num_workers=0)
         orig_atom_fea_len = dataset[0][0].shape[-1]
 
-        sample_data_list = [dataset[i] for i in range(int(train_ratio * len(dataset)))]
         d["n"].append(len(dataset))
-        _, sample_target, _ = collate_pool(sample_data_list)
-        normalizer = Normalizer(sample_target)
+        normalizer = Normalizer.from_targets(dataset_targets(Subset(dataset, range(int(train_ratio * len(dataset))))))
 
         model = PeriodicSetTransformer(orig_atom_fea_len,
                                        hp["fea_len"],
@@ -118,7 +126,10 @@ def main(verbose=True):
                                        components=["composition", "pdd"],
                                        attention_dropout=hp["attention_dropout"],
                                        use_cuda=use_cuda,
-                                       atom_encoding="mat2vec",)
+                                       atom_encoding="mat2vec",
+                                       mask_padding=hp.get("mask_padding", False),
+                                       attention=hp.get("attention", "bmm"),
+                                       fuse_embedding=hp.get("fuse_embedding", False))
         model.cuda()
         criterion = nn.L1Loss()
         optimizer = optim.AdamW(model.parameters(), training_options["lr"],
@@ -136,7 +147,7 @@ def main(verbose=True):
         train_time_start = time.time()
         for epoch in range(training_options["epochs"]):
             train(train_loader, model, criterion, optimizer, epoch, normalizer, cuda=use_cuda,
-                  print_epoch=epoch % 50 == 0)
+                  print_epoch=epoch % 50 == 0, prefetch=training_options.get("prefetch", False))
             scheduler.step()
 
         train_time_end = time.time()
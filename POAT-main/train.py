@@ -1,5 +1,7 @@
+import queue
 import shutil
 import shutil
+import threading
 import time
 import numpy as np
 np.random.seed(0)
@@ -9,35 +11,110 @@ from torch.autograd import Variable
 from data import *
 
 
-def train(train_loader, model, criterion, optimizer, epoch, normalizer, cuda=True, print_epoch=True):
+def _prepare_batch(batch, normalizer, cuda):
+    # target is returned on the device too, so the metrics are computed there without a sync
+    input, target, batch_cif_ids = batch
+    if cuda:
+        input_var = [Variable(i).cuda(non_blocking=True) for i in input]
+        target_var = Variable(normalizer.norm(target).cuda(non_blocking=True))
+        target = target.cuda(non_blocking=True)
+    else:
+        input_var = [Variable(i) for i in input]
+        target_var = Variable(normalizer.norm(target))
+    return input_var, target_var, target, batch_cif_ids
+
+
+def _batches(loader, normalizer, cuda):
+    for batch in loader:
+        yield _prepare_batch(batch, normalizer, cuda)
+
+
+class BatchPrefetcher(object):
+    """
+    Double-buffered iterator over a loader: a background thread collates batch N+1,
+    normalizes its target and copies it to the GPU (on its own CUDA stream) while batch N
+    is used. Yields (input_var, target_var, target, batch_cif_ids). prepare_time is the
+    time spent preparing batches and wait_time the part of it the consumer waited for,
+    the difference was hidden behind compute.
+    """
+
+    def __init__(self, loader, normalizer, cuda=True, depth=2):
+        self.loader = loader
+        self.normalizer = normalizer
+        self.cuda = cuda
+        self.depth = depth
+        self.prepare_time = 0.0
+        self.wait_time = 0.0
+
+    def __len__(self):
+        return len(self.loader)
+
+    @property
+    def hidden_time(self):
+        return max(self.prepare_time - self.wait_time, 0.0)
+
+    def _produce(self, batches, stream):
+        try:
+            loader = iter(self.loader)
+            while True:
+                start = time.time()
+                try:
+                    batch = next(loader)
+                except StopIteration:
+                    break
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        prepared = _prepare_batch(batch, self.normalizer, self.cuda)
+                    event = torch.cuda.Event()
+                    event.record(stream)
+                else:
+                    prepared, event = _prepare_batch(batch, self.normalizer, self.cuda), None
+                self.prepare_time += time.time() - start
+                batches.put((prepared, event))
+            batches.put(None)
+        except Exception as e:
+            batches.put(e)
+
+    def __iter__(self):
+        self.prepare_time = 0.0
+        self.wait_time = 0.0
+        stream = torch.cuda.Stream() if self.cuda else None
+        batches = queue.Queue(maxsize=self.depth)
+        threading.Thread(target=self._produce, args=(batches, stream), daemon=True).start()
+        while True:
+            start = time.time()
+            item = batches.get()
+            self.wait_time += time.time() - start
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            prepared, event = item
+            if event is not None:
+                torch.cuda.current_stream().wait_event(event)
+                for tensor in prepared[0] + [prepared[1], prepared[2]]:
+                    tensor.record_stream(torch.cuda.current_stream())
+            yield prepared
+
+
+def train(train_loader, model, criterion, optimizer, epoch, normalizer, cuda=True, print_epoch=True, prefetch=False):
     batch_time = AverageMeter()
     data_time = AverageMeter()
-    losses = AverageMeter()
-    mae_errors = AverageMeter()
+    losses = DeviceMeter()
+    mae_errors = DeviceMeter()
 
     model.train()
 
+    batches = BatchPrefetcher(train_loader, normalizer, cuda) if prefetch else _batches(train_loader, normalizer, cuda)
     end = time.time()
-    for i, (input, target, _) in enumerate(train_loader):
+    for i, (input_var, target_var, target, _) in enumerate(batches):
         data_time.update(time.time() - end)
 
-        if cuda:
-            input_var = [Variable(i).cuda(non_blocking=True) for i in input]
-        else:
-            input_var = [Variable(i) for i in input]
-
-        target_normed = normalizer.norm(target)
-
-        if cuda:
-            target_var = Variable(target_normed.cuda(non_blocking=True))
-        else:
-            target_var = Variable(target_normed)
-
         output = model(input_var)
         loss = criterion(output, target_var)
 
-        mae_error = mae(normalizer.denorm(output.data.cpu()), target)
-        losses.update(loss.data.cpu(), target.size(0))
+        mae_error = mae(normalizer.denorm(output.detach()), target)
+        losses.update(loss.detach(), target.size(0))
         mae_errors.update(mae_error, target.size(0))
 
         optimizer.zero_grad()
@@ -56,12 +133,16 @@ def train(train_loader, model, criterion, optimizer, epoch, normalizer, cuda=Tru
                 epoch, i, len(train_loader), batch_time=batch_time,
                 data_time=data_time, loss=losses, mae_errors=mae_errors)
             )
+    if prefetch and print_epoch:
+        print(f'Epoch: [{epoch}] prefetch hid {batches.hidden_time:.3f}s of '
+              f'{batches.prepare_time:.3f}s batch preparation')
 
 
-def validate(val_loader, model, criterion, normalizer, test=False, return_pred=False, cuda=True, return_target=False, return_id=False, csv_name='test_results.csv'):
+def validate(val_loader, model, criterion, normalizer, test=False, return_pred=False, cuda=True, return_target=False, return_id=False, csv_name='test_results.csv',
+             prefetch=False):
     batch_time = AverageMeter()
-    losses = AverageMeter()
-    mae_errors = AverageMeter()
+    losses = DeviceMeter()
+    mae_errors = DeviceMeter()
 
     if test:
         test_targets = []
@@ -70,34 +151,19 @@ def validate(val_loader, model, criterion, normalizer, test=False, return_pred=F
 
     model.eval()
 
+    batches = BatchPrefetcher(val_loader, normalizer, cuda) if prefetch else _batches(val_loader, normalizer, cuda)
     end = time.time()
-    for i, (input, target, batch_cif_ids) in enumerate(val_loader):
-        if cuda:
-            with torch.no_grad():
-                input_var = [Variable(i).cuda(non_blocking=True) for i in input]
-        else:
-            with torch.no_grad():
-                input_var = [Variable(i) for i in input]
-        target_normed = normalizer.norm(target)
-
-        if cuda:
-            with torch.no_grad():
-                target_var = Variable(target_normed.cuda(non_blocking=True))
-        else:
-            with torch.no_grad():
-                target_var = Variable(target_normed)
-
+    for i, (input_var, target_var, target, batch_cif_ids) in enumerate(batches):
         output = model(input_var)
         loss = criterion(output, target_var)
 
-        mae_error = mae(normalizer.denorm(output.data.cpu()), target)
-        losses.update(loss.data.cpu().item(), target.size(0))
+        mae_error = mae(normalizer.denorm(output.detach()), target)
+        losses.update(loss.detach().double(), target.size(0))
         mae_errors.update(mae_error, target.size(0))
         if test:
-            test_pred = normalizer.denorm(output.data.cpu())
-            test_target = target
-            test_preds += test_pred.view(-1).tolist()
-            test_targets += test_target.view(-1).tolist()
+            # Kept on the device and copied once after the loop
+            test_preds.append(normalizer.denorm(output.detach()).view(-1))
+            test_targets.append(target.view(-1))
             test_cif_ids += batch_cif_ids
         # measure elapsed time
         batch_time.update(time.time() - end)
@@ -111,6 +177,8 @@ def validate(val_loader, model, criterion, normalizer, test=False, return_pred=F
                 mae_errors=mae_errors))
 
     if test:
+        test_preds = torch.cat(test_preds).cpu().tolist() if test_preds else []
+        test_targets = torch.cat(test_targets).cpu().tolist() if test_targets else []
         star_label = '**'
         import csv
         with open(csv_name, 'w') as f:
@@ -122,6 +190,8 @@ def validate(val_loader, model, criterion, normalizer, test=False, return_pred=F
         star_label = '*'
     print(' {star} MAE {mae_errors.avg:.3f}'.format(star=star_label,
                                                     mae_errors=mae_errors))
+    if prefetch:
+        print(f' prefetch hid {batches.hidden_time:.3f}s of {batches.prepare_time:.3f}s batch preparation')
 
     if return_pred and return_target:
         if return_id:
@@ -132,12 +202,58 @@ def validate(val_loader, model, criterion, normalizer, test=False, return_pred=F
     return mae_errors.avg
 
 
+def _target_chunks(targets, chunk_size=65536):
+    if isinstance(targets, (torch.Tensor, np.ndarray)):
+        yield from torch.as_tensor(targets).reshape(-1).split(chunk_size)
+    else:
+        chunk = []
+        for target in targets:
+            chunk.extend(torch.as_tensor(target).reshape(-1).tolist())
+            if len(chunk) >= chunk_size:
+                yield torch.tensor(chunk, dtype=torch.float64)
+                chunk = []
+        if chunk:
+            yield torch.tensor(chunk, dtype=torch.float64)
+
+
+def _target_moments(targets):
+    """
+    Count, mean, sum of squared deviations, min and max of the targets in one pass. targets
+    is a tensor, an array or any iterable of values or chunks of values. Chunks are merged
+    with the parallel form of Welford's update in float64.
+    """
+    count, mean, m2 = 0, torch.zeros((), dtype=torch.float64), torch.zeros((), dtype=torch.float64)
+    low, high = None, None
+    for chunk in _target_chunks(targets):
+        if chunk.numel() == 0:
+            continue
+        chunk = chunk.double()
+        chunk_mean = chunk.mean()
+        delta = chunk_mean - mean
+        total = count + chunk.numel()
+        mean = mean + delta * chunk.numel() / total
+        m2 = m2 + ((chunk - chunk_mean) ** 2).sum() + delta ** 2 * count * chunk.numel() / total
+        count = total
+        low = chunk.min() if low is None else torch.minimum(low, chunk.min())
+        high = chunk.max() if high is None else torch.maximum(high, chunk.max())
+    return count, mean, m2, low, high
+
+
 class Normalizer(object):
 
     def __init__(self, tensor):
         self.mean = torch.mean(tensor)
         self.std = torch.std(tensor)
 
+    @classmethod
+    def from_targets(cls, targets):
+        """Same as Normalizer(tensor) but streams over the targets instead of needing them collated"""
+        count, mean, m2, _, _ = _target_moments(targets)
+        normalizer = cls.__new__(cls)
+        normalizer.load_state_dict({'mean': mean.float(),
+                                    'std': (m2 / (count - 1)).sqrt().float() if count > 1 else torch.tensor(float('nan'))})
+        return normalizer
+
     def norm(self, tensor):
         return (tensor - self.mean) / self.std
 
@@ -159,6 +275,14 @@ class SigmoidNormalizer(object):
         self.min = torch.min(tensor)
         self.max = torch.max(tensor)
 
+    @classmethod
+    def from_targets(cls, targets):
+        """Same as SigmoidNormalizer(tensor) but streams over the targets"""
+        _, _, _, low, high = _target_moments(targets)
+        normalizer = cls.__new__(cls)
+        normalizer.load_state_dict({'min': low.float(), 'max': high.float()})
+        return normalizer
+
     def norm(self, tensor) -> torch.Tensor:
         return (tensor - self.min) / (self.max - self.min)
     
@@ -229,6 +353,38 @@ class AverageMeter(object):
         self.avg = self.sum / self.count
 
 
+class DeviceMeter(object):
+    """
+    AverageMeter for tensor values: the running sum stays a tensor on the device of the
+    values, so updating does not sync. val, sum and avg are copied to the host when read.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._val = 0
+        self._sum = 0
+        self.count = 0
+
+    def update(self, val, n=1):
+        self._val = val
+        self._sum = self._sum + val * n
+        self.count += n
+
+    @property
+    def val(self):
+        return self._val.cpu() if torch.is_tensor(self._val) else self._val
+
+    @property
+    def sum(self):
+        return self._sum.cpu() if torch.is_tensor(self._sum) else self._sum
+
+    @property
+    def avg(self):
+        return self.sum / self.count if self.count else 0
+
+
 def save_checkpoint(state, is_best, filename='checkpoint.pth.tar'):
     torch.save(state, filename)
     if is_best: